@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Mock JSON-RPC node serving synthetic BOB transfers from the pool for benchmarks.
+# Every recipient gets one transfer, a part of recipients are contracts or already
+# have native tokens. Latency, errors and the limit of eth_getLogs range are configurable
+
+from json import loads, dumps
+from bisect import bisect_left, bisect_right
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from argparse import ArgumentParser
+
+from eth_utils import keccak
+
+TRANSFER_TOPIC = '0x' + keccak(text='Transfer(address,address,uint256)').hex()
+POOL_CONTRACT = '0x72e6B59D4a90ab232e55D4BB7ed2dD17494D62fB'
+BOB_TOKEN = '0xB0B195aEFA3650A6908f15CdaC7D92F8a5791B0B'
+CHAIN_ID = 137
+FAUCET_BALANCE = 10**24
+# All blocks of the mock chain are final, so every tag refers to the head
+HEAD_TAGS = ['latest', 'pending', 'safe', 'finalized']
+
+def to_topic(_address):
+    return '0x' + _address[2:].lower().rjust(64, '0')
+
+def block_hash(_number):
+    return '0x' + keccak(text=f'block{_number}').hex()
+
+class MockNode:
+    def __init__(self, _recipients, _first_block=1000, _blocks=10000, _events_per_block=None,
+                 _contracts_ratio=0.05, _funded_ratio=0.2, _small_ratio=0.1,
+                 _latency=0.0, _error_rate=0.0, _range_limit=0, _batch=True, _seed=1):
+        self.latency = _latency
+        self.error_rate = _error_rate
+        self.range_limit = _range_limit
+        self.batch = _batch
+        self.random = Random(_seed)
+        self.lock = Lock()
+        self.calls = {}
+        self.requests = 0
+        self.nonce = 0
+        self.receipts = {}
+
+        # Transfers are spread evenly among the blocks if the density is not set
+        if _events_per_block is None:
+            _events_per_block = max(_recipients // _blocks, 1)
+        self.codes = {}
+        self.balances = {}
+        self.recipients = set()
+        self.logs = []
+        for i in range(_recipients):
+            recipient = '0x' + keccak(text=f'recipient{i}')[-20:].hex()
+            self.recipients.add(recipient)
+            if i < _recipients * _contracts_ratio:
+                self.codes[recipient] = '0x6080604052'
+            elif i < _recipients * (_contracts_ratio + _funded_ratio):
+                self.balances[recipient] = 10**15
+            value = 10**18 if self.random.random() < _small_ratio else 20 * 10**18
+            block = _first_block + i // _events_per_block
+            self.logs.append({
+                'address': BOB_TOKEN,
+                'topics': [TRANSFER_TOPIC, to_topic(POOL_CONTRACT), to_topic(recipient)],
+                'data': '0x' + hex(value)[2:].rjust(64, '0'),
+                'blockNumber': hex(block),
+                'blockHash': block_hash(block),
+                'transactionHash': '0x' + keccak(text=f'transfer{i}').hex(),
+                'transactionIndex': hex(i % _events_per_block),
+                'logIndex': hex(i % _events_per_block),
+                'removed': False
+            })
+        self.log_blocks = [int(log['blockNumber'], 16) for log in self.logs]
+        self.head = _first_block + max(_blocks, len(self.logs) // _events_per_block + 1)
+
+    def count(self, _method):
+        with self.lock:
+            self.calls[_method] = self.calls.get(_method, 0) + 1
+            self.requests += 1
+
+    def block(self, _number):
+        return {
+            'number': hex(_number), 'hash': block_hash(_number), 'parentHash': block_hash(_number - 1),
+            'baseFeePerGas': hex(30 * 10**9), 'gasLimit': hex(30000000), 'gasUsed': hex(15000000),
+            'timestamp': hex(_number * 2), 'miner': '0x' + '0' * 40, 'extraData': '0x', 'difficulty': '0x1',
+            'totalDifficulty': '0x1', 'size': '0x1', 'nonce': '0x0000000000000000', 'sha3Uncles': '0x' + '0' * 64,
+            'logsBloom': '0x' + '0' * 512, 'transactionsRoot': '0x' + '0' * 64, 'stateRoot': '0x' + '0' * 64,
+            'receiptsRoot': '0x' + '0' * 64, 'mixHash': '0x' + '0' * 64, 'transactions': [], 'uncles': []
+        }
+
+    def get_logs(self, _filter):
+        from_block = int(_filter['fromBlock'], 16) if isinstance(_filter['fromBlock'], str) else _filter['fromBlock']
+        to_block = int(_filter['toBlock'], 16) if isinstance(_filter['toBlock'], str) else _filter['toBlock']
+        if self.range_limit > 0 and to_block - from_block + 1 > self.range_limit:
+            raise ValueError(f'block range is too wide, limit is {self.range_limit}')
+        return self.logs[bisect_left(self.log_blocks, from_block):bisect_right(self.log_blocks, to_block)]
+
+    def fee_history(self, _count, _newest_block):
+        count = int(_count, 16) if isinstance(_count, str) else _count
+        newest_block = int(_newest_block, 16) if isinstance(_newest_block, str) else _newest_block
+        return {
+            'oldestBlock': hex(newest_block - count + 1),
+            'baseFeePerGas': [hex(30 * 10**9 + i) for i in range(count + 1)],
+            'gasUsedRatio': [0.5] * count,
+            'reward': [[hex(10**9), hex(2 * 10**9)] for _ in range(count)]
+        }
+
+    def send_raw_transaction(self, _rawtx):
+        tx_hash = '0x' + keccak(hexstr=_rawtx).hex()
+        with self.lock:
+            self.receipts[tx_hash] = self.head
+            self.nonce += 1
+        return tx_hash
+
+    def receipt(self, _tx_hash):
+        block = self.receipts.get(_tx_hash)
+        if block is None:
+            return None
+        return {
+            'transactionHash': _tx_hash, 'blockNumber': hex(block), 'blockHash': block_hash(block), 'status': '0x1',
+            'transactionIndex': '0x0', 'from': '0x' + '0' * 40, 'to': '0x' + '0' * 40, 'cumulativeGasUsed': '0x5208',
+            'gasUsed': '0x5208', 'contractAddress': None, 'logs': [], 'logsBloom': '0x' + '0' * 512,
+            'effectiveGasPrice': hex(30 * 10**9), 'type': '0x2'
+        }
+
+    def call(self, _method, _params):
+        if _method == 'eth_chainId':
+            return hex(CHAIN_ID)
+        if _method == 'eth_blockNumber':
+            return hex(self.head)
+        if _method == 'eth_getBlockByNumber':
+            return self.block(self.head if _params[0] in HEAD_TAGS else int(_params[0], 16))
+        if _method == 'eth_getLogs':
+            return self.get_logs(_params[0])
+        if _method == 'eth_getCode':
+            return self.codes.get(_params[0].lower(), '0x')
+        if _method == 'eth_getBalance':
+            return hex(self.balance(_params[0]))
+        if _method == 'eth_getTransactionCount':
+            return hex(self.nonce)
+        if _method == 'eth_feeHistory':
+            return self.fee_history(_params[0], _params[1])
+        if _method == 'eth_sendRawTransaction':
+            return self.send_raw_transaction(_params[0])
+        if _method == 'eth_getTransactionReceipt':
+            return self.receipt(_params[0])
+        raise NotImplementedError(f'method {_method} is not supported')
+
+    # Recipients without native tokens have zero balance, other accounts are faucets
+    def balance(self, _address):
+        address = _address.lower()
+        if address in self.balances:
+            return self.balances[address]
+        return 0 if address in self.recipients else FAUCET_BALANCE
+
+    def handle(self, _request):
+        method = _request.get('method')
+        self.count(method)
+        response = {'jsonrpc': '2.0', 'id': _request.get('id')}
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            response['error'] = {'code': -32603, 'message': 'internal error'}
+            return response
+        try:
+            response['result'] = self.call(method, _request.get('params', []))
+        except NotImplementedError as e:
+            response['error'] = {'code': -32601, 'message': str(e)}
+        except ValueError as e:
+            response['error'] = {'code': -32005, 'message': str(e)}
+        return response
+
+    def serve(self, _port):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if node.latency > 0:
+                    sleep(node.latency)
+                body = loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if isinstance(body, list):
+                    node.count('batch')
+                    if node.batch:
+                        response = [node.handle(request) for request in body]
+                    else:
+                        response = {'jsonrpc': '2.0', 'id': None,
+                                    'error': {'code': -32600, 'message': 'batch requests are not supported'}}
+                else:
+                    response = node.handle(body)
+                data = dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', _port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Mock JSON-RPC node with synthetic BOB transfers')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--recipients', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every HTTP response in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered by an error')
+    parser.add_argument('--range-limit', type=int, default=0, help='max number of blocks in eth_getLogs')
+    parser.add_argument('--no-batch', action='store_true', help='reject batched requests')
+    args = parser.parse_args()
+
+    node = MockNode(args.recipients, _latency=args.latency, _error_rate=args.error_rate,
+                    _range_limit=args.range_limit, _batch=not args.no_batch)
+    port = node.serve(args.port)
+    print(f'Serving {args.recipients} transfers on http://127.0.0.1:{port}, head is {node.head}')
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        node.stop()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Mock WebSocket JSON-RPC endpoint serving subscriptions to new blocks and logs.
+# New heads and transfers are pushed by the caller, the connections can be dropped
+# to check how the faucet falls back to polling and reconnects
+
+import asyncio
+from json import loads, dumps
+from threading import Thread, Event
+from time import sleep
+from argparse import ArgumentParser
+
+import websockets
+
+# Seconds to wait for the server thread
+RUN_TIMEOUT = 5
+
+class MockWsNode:
+    def __init__(self, _logs=True):
+        # Some providers do not support subscriptions to logs
+        self.logs = _logs
+        # connection -> subscription kind -> subscription id
+        self.subscriptions = {}
+        self.loop = None
+        self.server = None
+
+    async def handle(self, _ws, _path=None):
+        subscriptions = {}
+        self.subscriptions[_ws] = subscriptions
+        try:
+            async for message in _ws:
+                request = loads(message)
+                response = {'jsonrpc': '2.0', 'id': request.get('id')}
+                kind = request.get('params', [None])[0]
+                if request.get('method') != 'eth_subscribe':
+                    response['error'] = {'code': -32601, 'message': f'method {request.get("method")} not supported'}
+                elif kind == 'newHeads' or (kind == 'logs' and self.logs):
+                    subscriptions[kind] = hex(len(subscriptions) + 1)
+                    response['result'] = subscriptions[kind]
+                else:
+                    response['error'] = {'code': -32602, 'message': f'subscription to {kind} is not supported'}
+                await _ws.send(dumps(response))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.subscriptions.pop(_ws, None)
+
+    # Runs the coroutine in the loop of the server and waits for its result,
+    # a broken server fails the caller instead of blocking it forever
+    def run(self, _coroutine):
+        return asyncio.run_coroutine_threadsafe(_coroutine, self.loop).result(RUN_TIMEOUT)
+
+    def notify(self, _kind, _result):
+        async def send():
+            for ws, subscriptions in list(self.subscriptions.items()):
+                if _kind in subscriptions:
+                    await ws.send(dumps({'jsonrpc': '2.0', 'method': 'eth_subscription',
+                                         'params': {'subscription': subscriptions[_kind], 'result': _result}}))
+        self.run(send())
+
+    def push_head(self, _number):
+        self.notify('newHeads', {'number': hex(_number)})
+
+    def push_log(self, _block, _removed=False):
+        self.notify('logs', {'blockNumber': hex(_block), 'removed': _removed})
+
+    # Closes all connections like a provider dropping the subscriptions
+    def drop(self):
+        async def close():
+            for ws in list(self.subscriptions):
+                await ws.close()
+        self.run(close())
+
+    def serve(self, _port):
+        started = Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(websockets.serve(self.handle, '127.0.0.1', _port))
+            started.set()
+            self.loop.run_forever()
+
+        Thread(target=run, daemon=True).start()
+        # The server thread dies without setting the event if websockets does not work with this Python
+        if not started.wait(RUN_TIMEOUT):
+            raise RuntimeError(f'WebSocket server is not started on port {_port}')
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self.server is None:
+            return
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+        self.run(close())
+        self.server = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Mock WebSocket JSON-RPC endpoint with subscriptions to new blocks')
+    parser.add_argument('--port', type=int, default=8546)
+    parser.add_argument('--head', type=int, default=11000, help='number of the first pushed block')
+    parser.add_argument('--block-time', type=float, default=2.0, help='seconds between new blocks')
+    parser.add_argument('--drop-every', type=int, default=0, help='drop connections every N blocks')
+    parser.add_argument('--no-logs', action='store_true', help='reject subscriptions to logs')
+    args = parser.parse_args()
+
+    node = MockWsNode(not args.no_logs)
+    port = node.serve(args.port)
+    print(f'Serving subscriptions on ws://127.0.0.1:{port}, first head is {args.head}')
+    head = args.head
+    try:
+        while True:
+            sleep(args.block_time)
+            node.push_head(head)
+            if args.drop_every > 0 and head % args.drop_every == 0:
+                node.drop()
+            head += 1
+    except KeyboardInterrupt:
+        node.stop()
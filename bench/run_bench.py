@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Runs the faucet against the mock JSON-RPC node for several numbers of recipients
+# and reports the duration of the first cycle, the number of RPC requests and
+# the peak memory of the faucet process
+
+from json import dump
+from os import path, environ, wait4, WEXITSTATUS
+from time import monotonic
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser
+import subprocess
+import sys
+
+from mock_node import MockNode
+
+FAUCET_SCRIPT = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'bridge-faucet.py')
+# Well known test key, the mock node treats any unknown account as a funded faucet
+FAUCET_PRIVKEY = '4c0883a69102937d6231471b5dbb6204fe5129617082792ae468d01a3f362318'
+STOP_FILE = 'stop.tmp'
+CYCLE_STARTED = 'Suggested range of blocks'
+CYCLE_FINISHED = 'Storing new bunch of historical records'
+
+# Starts the faucet with the mock node as the RPC provider, stops it after the first cycle.
+# Returns the metrics of the scenario
+def run_scenario(_recipients, _args):
+    node = MockNode(_recipients, _latency=_args.latency, _error_rate=_args.error_rate,
+                    _range_limit=_args.range_limit, _batch=not _args.no_batch)
+    port = node.serve(0)
+    with TemporaryDirectory() as db_dir:
+        env = dict(environ,
+                   ZKBOB_RPC=f'http://127.0.0.1:{port}',
+                   FAUCET_PRIVKEY=FAUCET_PRIVKEY,
+                   JSON_DB_DIR=db_dir,
+                   INITIAL_START_BLOCK=str(node.log_blocks[0] - 1),
+                   FINALIZATION_INTERVAL='0',
+                   POLLING_INTERVAL='1',
+                   WEB3_RETRY_DELAY='0')
+        env.update(dict(setting.split('=', 1) for setting in _args.env))
+
+        started = monotonic()
+        faucet = subprocess.Popen([sys.executable, FAUCET_SCRIPT], env=env, cwd=db_dir,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        cycle_started = None
+        cycle_finished = None
+        rewarded = 0
+        errors = 0
+        for line in faucet.stdout:
+            if _args.verbose:
+                print(line, end='')
+            if CYCLE_STARTED in line and cycle_started is None:
+                cycle_started = monotonic()
+                node_requests_before_cycle = node.requests
+            elif ' rewarded by ' in line:
+                rewarded += 1
+            elif line.startswith('ERROR'):
+                errors += 1
+            elif CYCLE_FINISHED in line and cycle_finished is None:
+                cycle_finished = monotonic()
+                node_requests = node.requests - node_requests_before_cycle
+                calls = dict(node.calls)
+                open(path.join(db_dir, STOP_FILE), 'w').close()
+        # Resources of the exact child process are collected to get its peak memory
+        _, status, usage = wait4(faucet.pid, 0)
+        faucet.returncode = WEXITSTATUS(status)
+    node.stop()
+
+    if cycle_finished is None:
+        raise RuntimeError(f'The faucet exited with code {faucet.returncode} before the end of the cycle')
+    return {
+        'recipients': _recipients,
+        'rewarded': rewarded,
+        'errors': errors,
+        'startup': cycle_started - started,
+        'cycle': cycle_finished - cycle_started,
+        'requests': node_requests,
+        'calls': calls,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': usage.ru_maxrss / 1024
+    }
+
+def print_report(_results):
+    print(f'{"recipients":>10} {"rewarded":>9} {"errors":>7} {"startup,s":>10} {"cycle,s":>9} {"requests":>9} {"peak RSS,MB":>12}')
+    for r in _results:
+        print(f'{r["recipients"]:>10} {r["rewarded"]:>9} {r["errors"]:>7} {r["startup"]:>10.2f} {r["cycle"]:>9.2f} '
+              f'{r["requests"]:>9} {r["peak_rss_mb"]:>12.1f}')
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark of the faucet cycle against the mock JSON-RPC node')
+    parser.add_argument('--recipients', default='10,100,1000,10000,100000',
+                        help='comma-separated numbers of recipients, one scenario per number')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every RPC response in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of RPC requests answered by an error')
+    parser.add_argument('--range-limit', type=int, default=0, help='max number of blocks in eth_getLogs')
+    parser.add_argument('--no-batch', action='store_true', help='the mock node rejects batched requests')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional environment variable of the faucet, can be repeated')
+    parser.add_argument('--json', help='file to store the results')
+    parser.add_argument('--verbose', action='store_true', help='print the output of the faucet')
+    args = parser.parse_args()
+
+    results = []
+    for recipients in [int(n) for n in args.recipients.split(',')]:
+        print(f'Running the scenario with {recipients} recipients', flush=True)
+        results.append(run_scenario(recipients, args))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            dump(results, f, indent=2)
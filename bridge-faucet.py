@@ -1,33 +1,59 @@
 #!/usr/bin/env python3
 
-from json import load, dump, loads
+from json import load, dump, loads, dumps
 import ast
 
 from web3 import Web3, HTTPProvider
 from web3.middleware import geth_poa_middleware
-from web3.exceptions import TransactionNotFound
+from web3.providers.base import BaseProvider
+from hexbytes import HexBytes
+from eth_abi import encode_abi
+
+import requests
 
 from eth_account import Account
 
-from time import sleep
+from time import sleep, monotonic, time, strftime, localtime
+from random import uniform
+from threading import Lock, Thread, Condition, current_thread
+
+import asyncio
+import websockets
 
-from os import getenv
+from os import getenv, path, replace, fsync, remove
 from dotenv import load_dotenv
 
 from logging import basicConfig, info, error, warning, INFO
 
-from statistics import median, mean
+from statistics import mean
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import sqlite3
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque, OrderedDict
+from sys import intern
+from contextlib import contextmanager
+from signal import signal, SIGUSR1
+import cProfile
 
 basicConfig(level=INFO)
 
 STOP_FILE = 'stop.tmp'
+PROFILE_FILE = 'profile.tmp'
 
 dotenv_read = False
 
 while True: 
     ZKBOB_RPC = getenv('ZKBOB_RPC', 'https://rpc.ankr.com/polygon')
+    ZKBOB_WS_RPC = getenv('ZKBOB_WS_RPC', '')
     RPC_LIMIT_BLOCK_RANGE = int(getenv('RPC_LIMIT_BLOCK_RANGE', 3000))
     HISTORY_BLOCK_RANGE = int(getenv('HISTORY_BLOCK_RANGE', 3000))
+    CATCHUP_BLOCK_RANGE = int(getenv('CATCHUP_BLOCK_RANGE', 100000))
+    LOGS_SCAN_WORKERS = int(getenv('LOGS_SCAN_WORKERS', 4))
     BLOCKS_TO_WAIT_BEFORE_RETRY = int(getenv('BLOCKS_TO_WAIT_BEFORE_RETRY', 300))
 
     BOB_TOKEN = getenv('BOB_TOKEN', '0xB0B195aEFA3650A6908f15CdaC7D92F8a5791B0B')
@@ -43,17 +69,44 @@ while True:
 
     GAS_LIMIT = int(getenv('GAS_LIMIT', 30000))
     REWARD = float(getenv('REWARD', 0.1))
+    DISPERSE_CONTRACT = getenv('DISPERSE_CONTRACT', '')
+    DISPERSE_GAS_PER_RECIPIENT = int(getenv('DISPERSE_GAS_PER_RECIPIENT', 40000))
+    DISPERSE_GAS_LIMIT = int(getenv('DISPERSE_GAS_LIMIT', 2000000))
     POLLING_INTERVAL = int(getenv('POLLING_INTERVAL', 60))
+    STUCK_TX_BLOCKS = int(getenv('STUCK_TX_BLOCKS', 20))
+    STUCK_TX_CHECK_INTERVAL = int(getenv('STUCK_TX_CHECK_INTERVAL', 10))
+    BROADCAST_WORKERS = int(getenv('BROADCAST_WORKERS', 8))
 
     INITIAL_START_BLOCK = int(getenv('INITIAL_START_BLOCK', 33709535))
     FINALIZATION_INTERVAL = int(getenv('FINALIZATION_INTERVAL', 128)) # blocks
+    FINALITY_TAG = getenv('FINALITY_TAG', 'finalized')
+    LOW_LATENCY_INTERVAL = int(getenv('LOW_LATENCY_INTERVAL', -1)) # blocks
 
     JSON_DB_DIR = getenv('JSON_DB_DIR', '.')
     JSON_HISTORY = getenv('JSON_HISTORY', 'faucet-history.json')
+    HISTORY_STORAGE = getenv('HISTORY_STORAGE', 'sqlite')
+    SQLITE_HISTORY = getenv('SQLITE_HISTORY', 'faucet-history.sqlite')
+    HANDLED_INDEX_LIMIT = int(getenv('HANDLED_INDEX_LIMIT', 1000000))
+    RECEIPT_CACHE_SIZE = int(getenv('RECEIPT_CACHE_SIZE', 100000))
     JSON_CONTRACTS = getenv('JSON_CONTRACTS', 'polygon-contracts.json')
+    SEND_JOURNAL = getenv('SEND_JOURNAL', 'faucet-sends.journal')
+    CODE_CACHE = getenv('CODE_CACHE', 'faucet-code-cache.log')
+    EOA_CACHE_SIZE = int(getenv('EOA_CACHE_SIZE', 1000000))
 
     WEB3_RETRY_ATTEMPTS = int(getenv('WEB3_RETRY_ATTEMPTS', 2))
     WEB3_RETRY_DELAY = int(getenv('WEB3_RETRY_DELAY', 5))
+    WEB3_RETRY_MAX_DELAY = int(getenv('WEB3_RETRY_MAX_DELAY', 60))
+    RPC_HEDGE_DELAY = float(getenv('RPC_HEDGE_DELAY', 1))
+    RPC_BREAKER_FAILURES = int(getenv('RPC_BREAKER_FAILURES', 3))
+    RPC_BREAKER_COOLDOWN = int(getenv('RPC_BREAKER_COOLDOWN', 30))
+    RPC_BATCH_SIZE = int(getenv('RPC_BATCH_SIZE', 100))
+    RPC_RATE_LIMIT = float(getenv('RPC_RATE_LIMIT', 0))
+    RPC_RATE_BURST = int(getenv('RPC_RATE_BURST', 10))
+
+    METRICS_PORT = int(getenv('METRICS_PORT', 0))
+    PROFILE_CYCLES = int(getenv('PROFILE_CYCLES', 3))
+
+    CHAINS_CONFIG = getenv('CHAINS_CONFIG', '')
 
     TEST_TO_SEND = getenv('TEST_TO_SEND', False)
 
@@ -62,7 +115,7 @@ while True:
     else:
         TEST_TO_SEND = False
 
-    if not FAUCET_PRIVKEY:
+    if not FAUCET_PRIVKEY and not CHAINS_CONFIG:
         if dotenv_read:
             break
 
@@ -72,12 +125,15 @@ while True:
     else: 
         break
 
-if not FAUCET_PRIVKEY:
+if not FAUCET_PRIVKEY and not CHAINS_CONFIG:
     raise BaseException("Faucet's privkey is not provided. Check the configuration")
 
 info(f'ZKBOB_RPC = {ZKBOB_RPC}')
+info(f'ZKBOB_WS_RPC = {ZKBOB_WS_RPC}')
 info(f'RPC_LIMIT_BLOCK_RANGE = {RPC_LIMIT_BLOCK_RANGE}')
 info(f'HISTORY_BLOCK_RANGE = {HISTORY_BLOCK_RANGE}')
+info(f'CATCHUP_BLOCK_RANGE = {CATCHUP_BLOCK_RANGE}')
+info(f'LOGS_SCAN_WORKERS = {LOGS_SCAN_WORKERS}')
 info(f'BLOCKS_TO_WAIT_BEFORE_RETRY = {BLOCKS_TO_WAIT_BEFORE_RETRY}')
 info(f'BOB_TOKEN = {BOB_TOKEN}')
 info(f'POOL_CONTRACT = {POOL_CONTRACT}')
@@ -89,18 +145,46 @@ info(f'BASE_FEE_RATIO = {BASE_FEE_RATIO}')
 info(f'FEE_LIMIT = {FEE_LIMIT}')
 info(f'GAS_LIMIT = {GAS_LIMIT}')
 info(f'REWARD = {REWARD}')
+info(f'DISPERSE_CONTRACT = {DISPERSE_CONTRACT}')
+info(f'DISPERSE_GAS_PER_RECIPIENT = {DISPERSE_GAS_PER_RECIPIENT}')
+info(f'DISPERSE_GAS_LIMIT = {DISPERSE_GAS_LIMIT}')
 info(f'POLLING_INTERVAL = {POLLING_INTERVAL}')
+info(f'STUCK_TX_BLOCKS = {STUCK_TX_BLOCKS}')
+info(f'STUCK_TX_CHECK_INTERVAL = {STUCK_TX_CHECK_INTERVAL}')
+info(f'BROADCAST_WORKERS = {BROADCAST_WORKERS}')
 info(f'INITIAL_START_BLOCK = {INITIAL_START_BLOCK}')
 info(f'FINALIZATION_INTERVAL = {FINALIZATION_INTERVAL}')
+info(f'FINALITY_TAG = {FINALITY_TAG}')
+info(f'LOW_LATENCY_INTERVAL = {LOW_LATENCY_INTERVAL}')
 info(f'JSON_DB_DIR = {JSON_DB_DIR}')
 info(f'JSON_HISTORY = {JSON_HISTORY}')
+info(f'HISTORY_STORAGE = {HISTORY_STORAGE}')
+info(f'SQLITE_HISTORY = {SQLITE_HISTORY}')
+info(f'HANDLED_INDEX_LIMIT = {HANDLED_INDEX_LIMIT}')
+info(f'RECEIPT_CACHE_SIZE = {RECEIPT_CACHE_SIZE}')
 info(f'JSON_CONTRACTS = {JSON_CONTRACTS}')
+info(f'SEND_JOURNAL = {SEND_JOURNAL}')
+info(f'CODE_CACHE = {CODE_CACHE}')
+info(f'EOA_CACHE_SIZE = {EOA_CACHE_SIZE}')
 info(f'WEB3_RETRY_ATTEMPTS = {WEB3_RETRY_ATTEMPTS}')
 info(f'WEB3_RETRY_DELAY = {WEB3_RETRY_DELAY}')
+info(f'WEB3_RETRY_MAX_DELAY = {WEB3_RETRY_MAX_DELAY}')
+info(f'RPC_HEDGE_DELAY = {RPC_HEDGE_DELAY}')
+info(f'RPC_BREAKER_FAILURES = {RPC_BREAKER_FAILURES}')
+info(f'RPC_BREAKER_COOLDOWN = {RPC_BREAKER_COOLDOWN}')
+info(f'RPC_BATCH_SIZE = {RPC_BATCH_SIZE}')
+info(f'RPC_RATE_LIMIT = {RPC_RATE_LIMIT}')
+info(f'RPC_RATE_BURST = {RPC_RATE_BURST}')
+info(f'METRICS_PORT = {METRICS_PORT}')
+info(f'PROFILE_CYCLES = {PROFILE_CYCLES}')
+info(f'CHAINS_CONFIG = {CHAINS_CONFIG}')
 info(f'TEST_TO_SEND = {TEST_TO_SEND}')
 
-if HISTORY_BLOCK_RANGE > RPC_LIMIT_BLOCK_RANGE:
-    raise BaseException("History block range cannot be greater than RPC limit block range")
+if FINALITY_TAG and not FINALITY_TAG in ['finalized', 'safe']:
+    raise BaseException(f'Unknown finality tag "{FINALITY_TAG}". Use "finalized", "safe" or empty value')
+
+if not HISTORY_STORAGE in ['sqlite', 'json']:
+    raise BaseException(f'Unknown history storage "{HISTORY_STORAGE}". Use "sqlite" or "json"')
 
 # event
 # event Transfer(address indexed from, address indexed to, uint256 value)
@@ -134,52 +218,870 @@ ABI = """
 ]
 """
 
-plg_w3 = Web3(HTTPProvider(ZKBOB_RPC))
-plg_w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-
-plg_chainId = plg_w3.eth.chain_id
-
-bob_token = plg_w3.eth.contract(abi = ABI, address = BOB_TOKEN)
-event_filter = bob_token.events.Transfer.build_filter()
-event_filter.indexed_args[0].match_single(POOL_CONTRACT)
-token = {
-    'cnt': bob_token,
-    'efilter': event_filter,
-    'handler': bob_token.events.Transfer().processLog
+# Weight of the latest observation in the moving averages of the endpoints statistics
+RPC_EWMA_ALPHA = 0.2
+# JSON-RPC methods which are sent to all healthy endpoints
+RPC_WRITE_METHODS = ['eth_sendRawTransaction']
+
+# Priorities of JSON-RPC requests waiting for the rate limiter, lower values are served first:
+# sending of rewards and nonces, then checks of recipients, then scans of logs
+RPC_PRIORITY_SEND = 0
+RPC_PRIORITY_CHECK = 1
+RPC_PRIORITY_SCAN = 2
+RPC_METHOD_PRIORITIES = {
+    'eth_sendRawTransaction': RPC_PRIORITY_SEND,
+    'eth_getTransactionCount': RPC_PRIORITY_SEND,
+    'eth_getLogs': RPC_PRIORITY_SCAN,
 }
+# The rate is halved when the provider throttles requests but not below this share
+# of RPC_RATE_LIMIT, every successful request restores this share of RPC_RATE_LIMIT
+RPC_RATE_MIN_RATIO = 0.1
+RPC_RATE_INCREASE_RATIO = 0.01
+# Parts of error messages returned by RPC providers when the rate of requests is exceeded
+RATE_LIMIT_ERRORS = ['rate limit', 'too many requests', 'request limit', 'requests limit', 'throttl', 
+                     'capacity exceeded', 'exceeded the quota']
+
+# Checks if the exception, the JSON-RPC error or the HTTP response means the provider throttles requests
+def is_rate_limit_error(_error):
+    if isinstance(_error, requests.Response):
+        return _error.status_code == 429
+    if isinstance(_error, requests.HTTPError):
+        return _error.response is not None and _error.response.status_code == 429
+    if isinstance(_error, Exception) and _error.args and isinstance(_error.args[0], dict):
+        _error = _error.args[0]
+    if isinstance(_error, dict):
+        if _error.get('code') == 429:
+            return True
+        message = str(_error.get('message', '')).lower()
+    else:
+        message = str(_error).lower()
+    return any(pattern in message for pattern in RATE_LIMIT_ERRORS)
+
+# JSON-RPC errors caused by the state of the node rather than by the request, e.g. a node
+# lagging behind the chain responds by "header not found" for recent blocks
+NODE_ERROR_CODES = [-32603]
+NODE_ERRORS = ['header not found', 'missing trie node', 'unknown block', 'internal error', 'timeout', 'timed out']
+
+# Checks if the JSON-RPC error means the endpoint failed to serve the request
+def is_node_error(_error):
+    if not isinstance(_error, dict):
+        return False
+    message = str(_error.get('message', '')).lower()
+    # Ranges of blocks refused by eth_getLogs are split by the caller instead
+    if any(pattern in message for pattern in LOGS_RANGE_ERRORS):
+        return False
+    return _error.get('code') in NODE_ERROR_CODES or any(pattern in message for pattern in NODE_ERRORS)
+
+# Token bucket limiting requests to an RPC endpoint by RPC_RATE_LIMIT requests per second
+# with bursts up to RPC_RATE_BURST requests. Waiting requests of higher priority take tokens
+# first. The rate is adapted to the provider: halved when requests are throttled and
+# increased gradually by successful requests
+class RateLimiter:
+    def __init__(self, _rate, _burst):
+        self.max_rate = _rate
+        self.rate = _rate
+        self.burst = max(_burst, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.decreased = 0
+        self.condition = Condition()
+        # number of waiting requests by priorities
+        self.waiting = [0] * (RPC_PRIORITY_SCAN + 1)
+
+    # Waits until _cost tokens are available. A request costing more than the burst
+    # is served when the bucket is full, the next requests wait for the deficit
+    def acquire(self, _priority, _cost=1):
+        if self.max_rate <= 0:
+            return
+        with self.condition:
+            self.waiting[_priority] += 1
+            try:
+                while True:
+                    now = monotonic()
+                    self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+                    self.updated = now
+                    needed = min(_cost, self.burst)
+                    if self.tokens >= needed and sum(self.waiting[:_priority]) == 0:
+                        self.tokens -= _cost
+                        return
+                    self.condition.wait(max(needed - self.tokens, 1) / self.rate)
+            finally:
+                self.waiting[_priority] -= 1
+                self.condition.notify_all()
+
+    def throttled(self):
+        if self.max_rate <= 0:
+            return
+        with self.condition:
+            # Concurrent requests throttled at once decrease the rate only once
+            now = monotonic()
+            if now - self.decreased < 1:
+                return
+            self.decreased = now
+            self.rate = max(self.rate / 2, self.max_rate * RPC_RATE_MIN_RATIO)
+            self.tokens = min(self.tokens, 0)
+            rate = self.rate
+        warning(f'RPC provider throttles requests, the rate is reduced to {rate:.1f} requests per second')
+
+    def succeeded(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.condition:
+            self.rate = min(self.rate + self.max_rate * RPC_RATE_INCREASE_RATIO, self.max_rate)
+
+# Rate limiters are shared by all chains using the same RPC endpoint
+rate_limiters = {}
+
+def get_rate_limiter(_uri):
+    return rate_limiters.setdefault(_uri, RateLimiter(RPC_RATE_LIMIT, RPC_RATE_BURST))
+
+# An RPC endpoint with statistics of its latency and errors.
+# After RPC_BREAKER_FAILURES consecutive failures the endpoint is not used
+# for RPC_BREAKER_COOLDOWN seconds, then it gets one trial request
+class RpcEndpoint:
+    def __init__(self, _uri):
+        self.uri = _uri
+        self.provider = HTTPProvider(_uri)
+        self.limiter = get_rate_limiter(_uri)
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+
+    def is_available(self, _now):
+        return self.open_until <= _now
+
+    def record_success(self, _latency):
+        self.latency = _latency if self.latency is None else \
+                       (1 - RPC_EWMA_ALPHA) * self.latency + RPC_EWMA_ALPHA * _latency
+        self.error_rate = (1 - RPC_EWMA_ALPHA) * self.error_rate
+        self.failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.error_rate = (1 - RPC_EWMA_ALPHA) * self.error_rate + RPC_EWMA_ALPHA
+        self.failures += 1
+        if self.failures >= RPC_BREAKER_FAILURES:
+            warning(f'RPC endpoint {self.uri} failed {self.failures} times, not using it for {RPC_BREAKER_COOLDOWN} seconds')
+            self.open_until = monotonic() + RPC_BREAKER_COOLDOWN
+
+    # Expected time to get a response: endpoints with errors are penalized,
+    # endpoints without statistics are tried first to get it
+    def score(self):
+        if self.latency is None:
+            return 0
+        return self.latency / max(1 - self.error_rate, 0.01)
+
+# web3 provider distributing requests among several RPC endpoints.
+# Reads are sent to the fastest healthy endpoint, if it does not respond
+# in RPC_HEDGE_DELAY seconds the same request is sent to the next endpoint
+# and the first response is used. Writes are sent to all healthy endpoints
+class PooledProvider(BaseProvider):
+    def __init__(self, _name, _uris):
+        self.name = _name
+        self.endpoints = [RpcEndpoint(uri) for uri in _uris]
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(4 * len(self.endpoints), 8))
+        # Trace of the cycle if it is profiled
+        self.trace = None
+
+    def isConnected(self):
+        return any(endpoint.provider.isConnected() for endpoint in self.endpoints)
+
+    # Healthy endpoints ordered by their scores. If all endpoints are unavailable
+    # the one which becomes available first is returned
+    def ranked_endpoints(self):
+        now = monotonic()
+        with self.lock:
+            available = sorted([e for e in self.endpoints if e.is_available(now)], key=lambda e: e.score())
+            if len(available) == 0:
+                available = [min(self.endpoints, key=lambda e: e.open_until)]
+        return available
+
+    # Calls the endpoint when its rate limiter allows the request of the priority and the cost.
+    # JSON-RPC errors of the node are returned as responses but counted as failures of the endpoint
+    def call_endpoint(self, _endpoint, _priority, _cost, _func, *args):
+        _endpoint.limiter.acquire(_priority, _cost)
+        started = monotonic()
+        try:
+            result = _func(*args)
+        except Exception as e:
+            with self.lock:
+                _endpoint.record_failure()
+            if is_rate_limit_error(e):
+                _endpoint.limiter.throttled()
+            raise
+        # JSON-RPC errors and HTTP responses of batches are returned without exceptions
+        rejection = result.get('error') if isinstance(result, dict) else result
+        with self.lock:
+            if is_node_error(rejection):
+                _endpoint.record_failure()
+            else:
+                _endpoint.record_success(monotonic() - started)
+        if rejection is not None and is_rate_limit_error(rejection):
+            _endpoint.limiter.throttled()
+        else:
+            _endpoint.limiter.succeeded()
+        return result
+
+    def make_request(self, method, params):
+        priority = RPC_METHOD_PRIORITIES.get(method, RPC_PRIORITY_CHECK)
+        with self.measure([method], params) as outcome:
+            endpoints = self.ranked_endpoints()
+            if method in RPC_WRITE_METHODS:
+                response = self.broadcast(endpoints, method, params)
+            else:
+                response = self.hedged_call(endpoints, priority, 1, lambda e: e.provider.make_request(method, params))
+            outcome['response'] = response
+        if 'error' in response:
+            rpc_errors.labels(self.name, method, 'false').inc()
+        return response
+
+    # Records the latency of the request and counts it as an error if it fails. A batch
+    # is recorded for every method of its requests. If the cycle is traced, the request
+    # is added to the trace with the response put by the caller to the yielded dict
+    @contextmanager
+    def measure(self, _methods, _request, _batch=False):
+        batch = 'true' if _batch else 'false'
+        started = monotonic()
+        outcome = {}
+        try:
+            yield outcome
+        except Exception:
+            for method in _methods:
+                rpc_errors.labels(self.name, method, batch).inc()
+            raise
+        finally:
+            duration = monotonic() - started
+            for method in _methods:
+                rpc_latency.labels(self.name, method, batch).observe(duration)
+            if self.trace is not None:
+                self.trace.rpc(','.join(_methods), started, duration, _request, outcome.get('response'))
+
+    # Makes the request to the best endpoint and hedges it by the next endpoint
+    # if there is no response for RPC_HEDGE_DELAY seconds. If an endpoint fails
+    # or responds by an error of the node the request is repeated on the next one.
+    # If all endpoints respond by errors of the node the last such response is returned
+    def hedged_call(self, _endpoints, _priority, _cost, _request):
+        if len(_endpoints) == 1:
+            return self.call_endpoint(_endpoints[0], _priority, _cost, _request, _endpoints[0])
+        pending = set()
+        exc = None
+        failed_response = None
+        for i, endpoint in enumerate(_endpoints):
+            pending.add(self.executor.submit(self.call_endpoint, endpoint, _priority, _cost, _request, endpoint))
+            is_last = i == len(_endpoints) - 1
+            done, pending = wait(pending, timeout=None if is_last or RPC_HEDGE_DELAY <= 0 else RPC_HEDGE_DELAY,
+                                 return_when=FIRST_COMPLETED)
+            while len(done) > 0:
+                for future in done:
+                    if future.exception() is not None:
+                        exc = future.exception()
+                    elif is_node_error(future.result().get('error')):
+                        failed_response = future.result()
+                    else:
+                        return future.result()
+                # Wait for the hedged requests before trying the next endpoint
+                if len(pending) == 0 or not is_last:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        if failed_response is not None:
+            return failed_response
+        raise exc
+
+    # Sends the request to all endpoints, the first successful response is returned.
+    # If all endpoints reject the request the response of the best endpoint is returned
+    def broadcast(self, _endpoints, _method, _params):
+        futures = [self.executor.submit(self.call_endpoint, e, RPC_PRIORITY_SEND, 1, 
+                                        e.provider.make_request, _method, _params) 
+                   for e in _endpoints]
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and not 'error' in future.result():
+                    return future.result()
+        for future in futures:
+            if future.exception() is None:
+                return future.result()
+        raise futures[0].exception()
+
+    # Posts a JSON-RPC batch to the best endpoint, other endpoints are used if it fails
+    def post_batch(self, _payload):
+        def post(_endpoint):
+            request_kwargs = dict(_endpoint.provider.get_request_kwargs())
+            request_kwargs.setdefault('timeout', 10)
+            response = rpc_session.post(_endpoint.uri, json=_payload, **request_kwargs)
+            # Rejections of the batch itself are handled by the caller, other HTTP errors
+            # like 5xx fail over to the next endpoint and are counted by the circuit breaker
+            if response.status_code not in BATCH_REJECTION_STATUSES:
+                response.raise_for_status()
+            return response
+        # Providers count every request of the batch against the rate limit
+        priority = min([RPC_METHOD_PRIORITIES.get(request['method'], RPC_PRIORITY_CHECK) for request in _payload])
+        exc = None
+        methods = sorted(set([request['method'] for request in _payload]))
+        with self.measure(methods, _payload, True) as outcome:
+            for endpoint in self.ranked_endpoints():
+                try:
+                    outcome['response'] = self.call_endpoint(endpoint, priority, len(_payload), post, endpoint)
+                    return outcome['response']
+                except Exception as e:
+                    exc = e
+            raise exc
+
+# The session is reused by all batched JSON-RPC requests to keep connections alive
+rpc_session = requests.Session()
+
+# Metrics exposed in the Prometheus format on METRICS_PORT
+rpc_latency = Histogram('faucet_rpc_latency_seconds', 'Latency of JSON-RPC requests', ['chain', 'method', 'batch'])
+rpc_errors = Counter('faucet_rpc_errors_total', 'JSON-RPC requests failed or responded by an error', 
+                     ['chain', 'method', 'batch'])
+rpc_retries = Counter('faucet_rpc_retries_total', 'Web3 calls repeated after a failure')
+rpc_failed_calls = Counter('faucet_rpc_failed_calls_total', 'Web3 calls failed after all attempts')
+stage_duration = Histogram('faucet_stage_duration_seconds', 'Duration of stages of the cycle', ['chain', 'stage'],
+                           buckets=[0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300])
+head_lag = Gauge('faucet_head_lag_blocks', 'Number of blocks between the head and the last monitored block', ['chain'])
+pending_txs = Gauge('faucet_pending_txs', 'Reward transactions sent but not mined yet', ['chain', 'account'])
+faucet_balance_wei = Gauge('faucet_balance_wei', 'Balance of the faucet account', ['chain', 'account'])
+reorgs = Counter('faucet_reorgs_total', 'Reorgs of scanned blocks detected in the low-latency mode', ['chain'])
+
+# Listens to new blocks and BOB transfers from the pool over a WebSocket
+# subscription in a background thread. If the subscription to logs is not
+# supported by the RPC provider, only new blocks are tracked.
+# The connection is re-established if it drops
+class HeadSubscriber:
+    def __init__(self, _uri, _logs_filter, _finality_lag):
+        self.uri = _uri
+        self.logs_filter = _logs_filter
+        # Number of blocks between the head and the last block scanned by a cycle.
+        # It is updated by every cycle since the finalized block can lag behind the head
+        # more than FINALIZATION_INTERVAL blocks
+        self.finality_lag = _finality_lag
+        self.condition = Condition()
+        self.connected = False
+        self.logs_subscribed = False
+        self.head = None
+        # blocks with transfers from the pool which have not been scanned yet
+        self.event_blocks = set()
+        self.reconnects = 0
+        self.thread = Thread(target=self.run, name=f'{current_thread().name}-ws', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        while True:
+            try:
+                asyncio.get_event_loop().run_until_complete(self.listen())
+            except Exception as e:
+                error(f'WebSocket subscription to {self.uri} dropped: {e}')
+            with self.condition:
+                self.connected = False
+                self.logs_subscribed = False
+                self.condition.notify_all()
+            delay = max(min(WEB3_RETRY_DELAY * 2 ** min(self.reconnects, 16), WEB3_RETRY_MAX_DELAY), 1) * uniform(0.5, 1.5)
+            self.reconnects += 1
+            info(f'Falling back to polling, reconnect in {delay:.1f} seconds')
+            sleep(delay)
+
+    async def listen(self):
+        async with websockets.connect(self.uri) as ws:
+            await ws.send(dumps({'jsonrpc': '2.0', 'id': 'newHeads', 'method': 'eth_subscribe', 'params': ['newHeads']}))
+            await ws.send(dumps({'jsonrpc': '2.0', 'id': 'logs', 'method': 'eth_subscribe', 
+                                 'params': ['logs', self.logs_filter]}))
+            subscriptions = {}
+            async for message in ws:
+                message = loads(message)
+                if message.get('id') in ['newHeads', 'logs']:
+                    if 'error' in message:
+                        # Without subscription to new blocks there is nothing to wait for
+                        if message['id'] == 'newHeads':
+                            raise ConnectionError(message['error'])
+                        warning(f'Subscription to logs is not supported: {message["error"]}')
+                        continue
+                    subscriptions[message['result']] = message['id']
+                    with self.condition:
+                        if message['id'] == 'newHeads':
+                            info(f'Subscribed to new blocks on {self.uri}')
+                            self.connected = True
+                            self.reconnects = 0
+                        else:
+                            info(f'Subscribed to BOB transfers on {self.uri}')
+                            self.logs_subscribed = True
+                    continue
+                params = message.get('params', {})
+                kind = subscriptions.get(params.get('subscription'))
+                result = params.get('result', {})
+                with self.condition:
+                    if kind == 'newHeads':
+                        self.head = int(result['number'], 16)
+                    elif kind == 'logs':
+                        block = int(result['blockNumber'], 16)
+                        if result.get('removed'):
+                            self.event_blocks.discard(block)
+                        else:
+                            self.event_blocks.add(block)
+                    self.condition.notify_all()
+
+    # Checks if there is a reason to start a new cycle: a block with BOB transfers
+    # is finalized or, if transfers are not tracked, any new block is finalized
+    def scan_needed(self, _last_block):
+        with self.condition:
+            if not self.connected or self.head is None:
+                return False
+            finalized = self.head - self.finality_lag
+            if self.logs_subscribed:
+                self.event_blocks = set([block for block in self.event_blocks if block > _last_block])
+                return any(block <= finalized for block in self.event_blocks)
+            return finalized > _last_block
+
+    def set_finality_lag(self, _finality_lag):
+        with self.condition:
+            self.finality_lag = _finality_lag
+
+    # Waits for a block newer than _known_head but not longer than _timeout seconds.
+    # Returns the new head or None if there is no new block or the subscription dropped
+    def wait_for_head(self, _known_head, _timeout):
+        deadline = monotonic() + _timeout
+        with self.condition:
+            while self.connected:
+                if self.head is not None and self.head != _known_head:
+                    return self.head
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        return None
 
-faucet = Account.privateKeyToAccount(FAUCET_PRIVKEY)
-
-sending_tested = False
+# Parts of error messages returned by RPC providers when eth_getLogs range is too wide
+# or the response is too big
+LOGS_RANGE_ERRORS = ['too many', 'range', 'limit', 'exceed', 'response size', 'more than']
+# Parts of error messages returned by RPC providers which do not support "finalized" or "safe" block tags.
+# Errors like "header not found" are transient and do not disable the tag
+UNSUPPORTED_TAG_ERRORS = ['unsupported tag', 'unsupported block tag', 'invalid block tag', 'unknown block tag', 
+                          'finalized block not found', 'safe block not found']
+# Seconds after which the block tag is requested again if the RPC provider did not support it
+FINALITY_TAG_PROBE_INTERVAL = 3600
+# Number of successful eth_getLogs requests in a row after which the reduced chunk size is doubled
+LOGS_CHUNK_GROWTH_SUCCESSES = 10
+
+# HTTP statuses by which RPC providers reject a batch of JSON-RPC requests: 405 if batches
+# are not supported, 413 if the batch is too large and 400 for other reasons
+BATCH_REJECTION_STATUSES = [400, 405, 413]
+# Parts of error messages by which RPC providers reject a batch as too large with HTTP 200
+BATCH_SIZE_ERRORS = ['too large', 'too big', 'batch size', 'batch limit', 'maximum batch']
+
+# Raised when the RPC provider does not accept a batch of JSON-RPC requests
+class BatchNotSupported(Exception):
+    pass
+
+# Raised when the RPC provider rejects the particular batch by the HTTP status,
+# e.g. 413 if the batch is too large
+class BatchRejected(Exception):
+    def __init__(self, _status):
+        super().__init__(f'HTTP {_status}')
+        self.status = _status
+
+# Keeps the history in a single JSON file. All updates are accumulated in memory
+# and the file is rewritten entirely when the updates are committed
+class JsonHistoryStorage:
+    def __init__(self, _path, _default_sender):
+        self.path = _path
+        self.default_sender = _default_sender
+        self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                storage = load(f)
+        except IOError:
+            self.last_block, self.history, self.nonces = None, {}, {}
+        else:
+            self.last_block = int(storage['last_block'])
+            self.history = storage['history']
+            self.nonces = storage['nonces']
+            # The gas prices log of files stored before several faucet accounts 
+            # were supported belongs to the first faucet account
+            if any(isinstance(gas_price, list) for gas_price in self.nonces.values()):
+                self.nonces = {self.default_sender: self.nonces}
+
+    def get_last_block(self):
+        return self.last_block
+
+    def get_history(self, _min_block):
+        return {block: dict(attempts) for block, attempts in self.history.items() if int(block) >= _min_block}
+
+    def get_nonces(self):
+        return {sender: {nonce: list(gas_price) for nonce, gas_price in sender_nonces.items()}
+                for sender, sender_nonces in self.nonces.items()}
+
+    def add_attempts(self, _block, _attempts):
+        self.history.setdefault(str(_block), {}).update(_attempts)
+
+    def prune_history(self, _min_block):
+        for block in list(self.history):
+            if int(block) < _min_block:
+                del self.history[block]
+
+    def rewind_history(self, _block):
+        for block in sorted([block for block in self.history if int(block) > _block], key=int):
+            self.history.setdefault(str(_block), {}).update(self.history.pop(block))
+
+    def store_nonce(self, _sender, _nonce, _gas_price):
+        self.nonces.setdefault(_sender, {})[str(_nonce)] = list(_gas_price)
+
+    def prune_nonces(self, _sender, _min_nonce):
+        sender_nonces = self.nonces.get(_sender, {})
+        for nonce in list(sender_nonces):
+            if int(nonce) < _min_nonce:
+                del sender_nonces[nonce]
+
+    def commit(self, _last_block):
+        self.last_block = _last_block
+        # The file is replaced only after the new content is completely written
+        # so a crash cannot leave it truncated
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as json_file:
+            dump({'last_block': _last_block, 
+                  'history': self.history,
+                  'nonces': self.nonces
+                 }, json_file)
+            json_file.flush()
+            fsync(json_file.fileno())
+        replace(tmp_path, self.path)
+
+    def rollback(self):
+        self._read()
+
+# Keeps the history in SQLite tables indexed by blocks and nonces. Every update
+# touches only affected rows, all updates made since the previous commit
+# are applied in one transaction
+class SqliteHistoryStorage:
+    def __init__(self, _path):
+        self.db = sqlite3.connect(_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS attempts (block INTEGER NOT NULL,
+                                                                account TEXT NOT NULL,
+                                                                tx_hash TEXT NOT NULL,
+                                                                PRIMARY KEY (block, account))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS nonces (sender TEXT NOT NULL,
+                                                              nonce INTEGER NOT NULL,
+                                                              max_gas_price INTEGER NOT NULL,
+                                                              priority_fee INTEGER NOT NULL,
+                                                              PRIMARY KEY (sender, nonce))""")
+        self.db.commit()
+
+    def get_last_block(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_block'").fetchone()
+        return row[0] if row else None
+
+    def get_history(self, _min_block):
+        history = {}
+        for block, account, tx_hash in self.db.execute('SELECT block, account, tx_hash FROM attempts WHERE block >= ?',
+                                                       (_min_block,)):
+            history.setdefault(str(block), {})[account] = tx_hash
+        return history
+
+    def get_nonces(self):
+        nonces = {}
+        for sender, nonce, max_gas_price, priority_fee in self.db.execute('SELECT * FROM nonces'):
+            nonces.setdefault(sender, {})[str(nonce)] = [max_gas_price, priority_fee]
+        return nonces
+
+    def add_attempts(self, _block, _attempts):
+        self.db.executemany('INSERT OR REPLACE INTO attempts VALUES (?, ?, ?)',
+                            [(int(_block), account, tx_hash) for account, tx_hash in _attempts.items()])
+
+    def prune_history(self, _min_block):
+        self.db.execute('DELETE FROM attempts WHERE block < ?', (_min_block,))
+
+    def rewind_history(self, _block):
+        # Later attempts to reward the same account replace earlier ones
+        self.db.execute("""INSERT OR REPLACE INTO attempts SELECT ?, account, tx_hash FROM attempts 
+                           WHERE block > ? ORDER BY block""", (_block, _block))
+        self.db.execute('DELETE FROM attempts WHERE block > ?', (_block,))
+
+    def store_nonce(self, _sender, _nonce, _gas_price):
+        self.db.execute('INSERT OR REPLACE INTO nonces VALUES (?, ?, ?, ?)', (_sender, int(_nonce), *_gas_price))
+
+    def prune_nonces(self, _sender, _min_nonce):
+        self.db.execute('DELETE FROM nonces WHERE sender = ? AND nonce < ?', (_sender, _min_nonce))
+
+    def commit(self, _last_block):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_block', ?)", (_last_block,))
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+# In-memory index of reward attempts which lives across cycles.
+# Blocks of attempts are kept sorted, so attempts made in a range of blocks are found by
+# binary search. Every account refers to its attempts ordered by blocks.
+# Attempts are evicted from the oldest block, at most _limit attempts are kept
+class HandledIndex:
+    def __init__(self, _limit):
+        self.limit = _limit
+        # blocks[first:] are the blocks with attempts, the evicted head is cut lazily
+        self.blocks = []
+        self.first = 0
+        # block -> {account: tx hash}, tx hashes are kept as bytes to save memory
+        self.attempts = {}
+        # account -> deque of blocks with attempts to reward the account
+        self.accounts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, _block, _attempts):
+        block = int(_block)
+        if not block in self.attempts:
+            if len(self.blocks) == self.first or block > self.blocks[-1]:
+                self.blocks.append(block)
+            else:
+                insort(self.blocks, block, self.first)
+            self.attempts[block] = {}
+        block_attempts = self.attempts[block]
+        for account, tx_hash in _attempts.items():
+            account = intern(account)
+            if not account in block_attempts:
+                self.size += 1
+                account_blocks = self.accounts.setdefault(account, deque())
+                if len(account_blocks) == 0 or block >= account_blocks[-1]:
+                    account_blocks.append(block)
+                else:
+                    account_blocks.insert(bisect_left(account_blocks, block), block)
+            block_attempts[account] = bytes(HexBytes(tx_hash))
+        while self.size > self.limit:
+            warning(f'Too many reward attempts kept in memory, dropping attempts made in block {self.blocks[self.first]}')
+            self.evict_before(self.blocks[self.first] + 1)
+
+    # Removes all attempts made earlier than _min_block
+    def evict_before(self, _min_block):
+        while self.first < len(self.blocks) and self.blocks[self.first] < _min_block:
+            block = self.blocks[self.first]
+            self.first += 1
+            for account in self.attempts.pop(block):
+                account_blocks = self.accounts[account]
+                account_blocks.popleft()
+                if len(account_blocks) == 0:
+                    del self.accounts[account]
+                self.size -= 1
+        if self.first > len(self.blocks) // 2:
+            del self.blocks[:self.first]
+            self.first = 0
+
+    # Moves attempts made after _block to _block, the latest attempt of every account is kept
+    def rewind(self, _block):
+        start = bisect_right(self.blocks, _block, self.first)
+        moved = {}
+        for block in self.blocks[start:]:
+            for account, tx_hash in self.attempts.pop(block).items():
+                moved[account] = tx_hash
+                account_blocks = self.accounts[account]
+                account_blocks.remove(block)
+                if len(account_blocks) == 0:
+                    del self.accounts[account]
+                self.size -= 1
+        del self.blocks[start:]
+        if len(moved) > 0:
+            self.add(_block, moved)
+
+    # Checks if there is an attempt to reward the account not earlier than _min_block
+    def handled_since(self, _account, _min_block):
+        account_blocks = self.accounts.get(_account)
+        return account_blocks is not None and account_blocks[-1] >= _min_block
+
+    # Returns transactions of attempts made from _min_block to _max_block (not included)
+    # grouped by accounts
+    def attempts_between(self, _min_block, _max_block):
+        accounts = {}
+        start = bisect_left(self.blocks, _min_block, self.first)
+        end = bisect_left(self.blocks, _max_block, start)
+        for block in self.blocks[start:end]:
+            for account, tx_hash in self.attempts[block].items():
+                accounts.setdefault(account, []).append(Web3.toHex(tx_hash))
+        return accounts
+
+# Write-ahead journal of reward transactions. Transactions are appended and synced
+# to the disk before they are broadcasted, the journal is cleared as soon as the attempts
+# are committed to the history storage. Entries left after a crash are replayed on start
+class SendJournal:
+    def __init__(self, _path):
+        self.path = _path
+        self.lock = Lock()
+        self.file = open(_path, 'a')
+
+    def append(self, _entries):
+        with self.lock:
+            for entry in _entries:
+                self.file.write(dumps(entry) + '\n')
+            self.file.flush()
+            fsync(self.file.fileno())
+
+    def read(self):
+        entries = []
+        with self.lock, open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(loads(line))
+                except ValueError:
+                    # The last entry could be written partially before the crash
+                    warning(f'Skipping broken entries at the end of {self.path}')
+                    break
+        return entries
+
+    def clear(self):
+        with self.lock:
+            self.file.truncate(0)
+            fsync(self.file.fileno())
+
+# Min number of records in the code cache log to consider its compaction
+CODE_CACHE_COMPACTION_MIN = 10000
+
+# Classification of recipients as contracts or EOAs. All known contracts and up to
+# _eoa_limit recently used EOAs are kept in memory. New classifications are appended
+# to the log, the log is rewritten when it is more than twice bigger than the cache
+class CodeCache:
+    def __init__(self, _path, _eoa_limit):
+        self.path = _path
+        self.eoa_limit = _eoa_limit
+        self.contracts = set()
+        # EOAs ordered from the least recently used ones
+        self.eoas = OrderedDict()
+        # number of records in the log and the records which are not written yet
+        self.records = 0
+        self.pending = []
+        if path.exists(_path):
+            with open(_path) as f:
+                for line in f:
+                    self.records += 1
+                    kind, _, address = line.strip().partition(' ')
+                    if kind == 'C':
+                        self._add_contract(address)
+                    elif kind == 'E':
+                        self._add_eoa(address)
+        info(f'Loaded {len(self.contracts)} contracts and {len(self.eoas)} EOAs from {_path}')
+        self.file = open(_path, 'a')
+
+    def _add_contract(self, _address):
+        self.contracts.add(_address)
+        self.eoas.pop(_address, None)
+
+    def _add_eoa(self, _address):
+        self.eoas[_address] = True
+        self.eoas.move_to_end(_address)
+        while len(self.eoas) > self.eoa_limit:
+            self.eoas.popitem(last=False)
+
+    # Returns True for a contract, False for an EOA and None if the address is not classified
+    def is_contract(self, _address):
+        if _address in self.contracts:
+            return True
+        if _address in self.eoas:
+            self.eoas.move_to_end(_address)
+            return False
+        return None
 
-# Loads data stored by previous run of the main loop
+    def add(self, _address, _is_contract):
+        if _is_contract:
+            self._add_contract(_address)
+        else:
+            self._add_eoa(_address)
+        self.pending.append(f'{"C" if _is_contract else "E"} {_address}\n')
+
+    # Appends new classifications to the log and compacts the log if it is too big
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.file.writelines(self.pending)
+        self.file.flush()
+        self.records += len(self.pending)
+        self.pending = []
+        if self.records > max(2 * (len(self.contracts) + len(self.eoas)), CODE_CACHE_COMPACTION_MIN):
+            self.compact()
+
+    def compact(self):
+        info(f'Compacting {self.path}: {self.records} records, {len(self.contracts)} contracts and {len(self.eoas)} EOAs')
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines([f'C {address}\n' for address in self.contracts])
+            f.writelines([f'E {address}\n' for address in self.eoas])
+            f.flush()
+            fsync(f.fileno())
+        self.file.close()
+        replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.records = len(self.contracts) + len(self.eoas)
+
+# Imports contracts cached in the JSON file by previous versions of the faucet
+def migrate_json_contracts(_json_path, _code_cache):
+    if not path.exists(_json_path):
+        return
+    with open(_json_path) as f:
+        contracts = load(f)
+    for address in contracts:
+        _code_cache.add(address, True)
+    _code_cache.flush()
+    replace(_json_path, f'{_json_path}.migrated')
+    info(f'Migrated {len(contracts)} contracts from {_json_path}')
+
+# An entry of the send journal for the signed transaction rewarding the recipients
+def journal_entry(_account, _nonce, _recipients, _rawtx, _gas_price, _block):
+    return {'sender': _account.address, 'nonce': _nonce, 'recipients': _recipients, 'block': _block,
+            'hash': Web3.toHex(_rawtx.hash), 'raw': Web3.toHex(_rawtx.rawTransaction), 
+            'gas_price': list(_gas_price)}
+
+# Moves the history from the JSON file to the SQLite storage if the SQLite storage
+# is empty. The JSON file is renamed after that in order not to import it again
+def migrate_json_history(_json_path, _storage, _default_sender):
+    if _storage.get_last_block() is not None or not path.exists(_json_path):
+        return
+    json_storage = JsonHistoryStorage(_json_path, _default_sender)
+    last_block = json_storage.get_last_block()
+    info(f'Migrating historical records from {_json_path}')
+    for block, attempts in json_storage.get_history(0).items():
+        _storage.add_attempts(block, attempts)
+    for sender, sender_nonces in json_storage.get_nonces().items():
+        for nonce, gas_price in sender_nonces.items():
+            _storage.store_nonce(sender, nonce, gas_price)
+    _storage.commit(last_block)
+    replace(_json_path, f'{_json_path}.migrated')
+    info(f'Migrated {len(json_storage.history)} historical records and last monitored block {last_block}')
+
+# Loads data stored by previous run of the faucet, it is done once at the start
 # If it is the very first run, the data is initialized with default values
-def get_storage_of_handled():
-    try:
-        with open(f'{JSON_DB_DIR}/{JSON_HISTORY}') as f:
-            storage = load(f)
-            previous_last_block = int(storage['last_block'])
-            handled_recipients = storage['history']
-            nonces = storage['nonces']
-            info(f'Found last monitored block: {previous_last_block} and have {len(handled_recipients)} historical records')
-    except IOError:
-        previous_last_block = INITIAL_START_BLOCK
-        handled_recipients = {}
-        nonces = {}
+def get_storage_of_handled(_chain):
+    previous_last_block = _chain.history_storage.get_last_block()
+    handled_index = HandledIndex(HANDLED_INDEX_LIMIT)
+    # Every faucet account has its own gas prices log
+    nonces = {account.address: {} for account in _chain.faucets}
+    if previous_last_block is None:
+        previous_last_block = _chain.INITIAL_START_BLOCK
         warning(f'no historical records found, suggesting discovery from {previous_last_block} block')
-    return previous_last_block, handled_recipients, nonces
+    else:
+        # Attempts made earlier will be pruned by the cycle anyway
+        history = _chain.history_storage.get_history(previous_last_block - 
+                                              (_chain.HISTORY_BLOCK_RANGE + _chain.BLOCKS_TO_WAIT_BEFORE_RETRY))
+        for block in sorted(history, key=int):
+            handled_index.add(block, history[block])
+        stored_nonces = _chain.history_storage.get_nonces()
+        for sender in nonces:
+            nonces[sender] = stored_nonces.get(sender, {})
+        info(f'Found last monitored block: {previous_last_block} and have {len(handled_index)} historical records')
+    return previous_last_block, handled_index, nonces
 
 # Stores the data after the latest run of the main loop
-def save_storage_of_handled(_observation_range, _handled_recipients, _nonces):
-    info(f'Storing new bunch of historical records {len(_handled_recipients)} and last monitored block {_observation_range[1]}')
-    with open(f'{JSON_DB_DIR}/{JSON_HISTORY}', 'w') as json_file:
-        dump({'last_block': _observation_range[1], 
-              'history': _handled_recipients,
-              'nonces': _nonces
-             }, json_file)
+def save_storage_of_handled(_chain, _observation_range, _handled_index):
+    info(f'Storing new bunch of historical records {len(_handled_index)} and last monitored block {_observation_range[1]}')
+    _chain.history_storage.commit(_observation_range[1])
+    _chain.journal.clear()
 
 # Call a web3 method with consequent retries if the call fails
 # It is possible to pass a list of exceptions which will not cause a retry
+# Delays between attempts grow exponentially from WEB3_RETRY_DELAY up to WEB3_RETRY_MAX_DELAY
+# and are randomized to avoid simultaneous retries
 def make_web3_call_with_exceptions(func, exceptions, *args, **kwargs):
     attempts = 0
     exc = None
@@ -198,204 +1100,528 @@ def make_web3_call_with_exceptions(func, exceptions, *args, **kwargs):
             except Exception as e:
                 error(f'Not able to get data')
                 exc = e                
+        delay = min(WEB3_RETRY_DELAY * 2 ** attempts, WEB3_RETRY_MAX_DELAY) * uniform(0.5, 1.5)
+        # Throttled requests are paced by the rate limiter instead of the delay
+        if RPC_RATE_LIMIT > 0 and is_rate_limit_error(exc):
+            delay = 0
         attempts += 1
-        info(f'Repeat attempt in {WEB3_RETRY_DELAY} seconds')
-        sleep(WEB3_RETRY_DELAY)
+        if attempts < WEB3_RETRY_ATTEMPTS:
+            info(f'Repeat attempt in {delay:.1f} seconds')
+            rpc_retries.inc()
+            sleep(delay)
+    rpc_failed_calls.inc()
     raise exc
 
 # Wrapper to call a web3 method without ability to catch specific exceptions 
 def make_web3_call(func, *args, **kwargs):
     return make_web3_call_with_exceptions(func, [], *args, **kwargs)
 
+# Makes a single JSON-RPC call and returns the raw result without web3 formatters applied
+def make_rpc_request(_chain, _method, _params):
+    response = _chain.w3.provider.make_request(_method, _params)
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response['result']
+
+# Sends a list of (method, params) as one JSON-RPC batch and returns the responses
+# in the same order as the calls. A response is None if the provider lost it
+def post_rpc_batch(_chain, _calls):
+    payload = [{'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params}
+               for i, (method, params) in enumerate(_calls)]
+    response = _chain.rpc_pool.post_batch(payload)
+    # Some providers reject batches on the HTTP level, others respond by a single error object
+    if response.status_code == 405:
+        raise BatchNotSupported(f'HTTP {response.status_code}')
+    if response.status_code in BATCH_REJECTION_STATUSES:
+        raise BatchRejected(response.status_code)
+    response.raise_for_status()
+    responses = response.json()
+    if not isinstance(responses, list):
+        # The batch is repeated if it is rejected due to the rate limit
+        if isinstance(responses, dict) and is_rate_limit_error(responses.get('error', responses)):
+            raise ValueError(responses['error'] if 'error' in responses else responses)
+        # The batch is halved like the one rejected by HTTP 413
+        if isinstance(responses, dict) and isinstance(responses.get('error'), dict):
+            message = str(responses['error'].get('message', '')).lower()
+            if any(pattern in message for pattern in BATCH_SIZE_ERRORS):
+                raise BatchRejected(413)
+        raise BatchNotSupported(responses.get('error', responses) if isinstance(responses, dict) else responses)
+    by_id = {r.get('id'): r for r in responses if isinstance(r, dict)}
+    return [by_id.get(i) for i in range(len(_calls))]
+
+# Makes a bunch of JSON-RPC calls grouped by batches of RPC_BATCH_SIZE requests.
+# Returns the raw results in the same order as the calls. If a call failed in the batch
+# it is repeated as a single call, if it fails again the exception takes its place in the list.
+# Falls back to single calls if the RPC provider does not support batches. If a batch is
+# too large for the provider, batches of the chain are halved
+def make_web3_batch_call(_chain, _calls):
+    results = [None] * len(_calls)
+    failed = list(range(len(_calls)))
+    if _chain.rpc_batch_supported and len(_calls) > 1:
+        failed = []
+        start = 0
+        while start < len(_calls):
+            chunk = _calls[start:start + _chain.rpc_batch_size]
+            try:
+                responses = make_web3_call_with_exceptions(post_rpc_batch, [BatchNotSupported, BatchRejected], 
+                                                           _chain, chunk)
+            except BatchNotSupported as e:
+                warning(f'RPC provider does not support batch requests ({e}), switching to single calls')
+                _chain.rpc_batch_supported = False
+                failed.extend(range(start, len(_calls)))
+                break
+            except BatchRejected as e:
+                if e.status == 413 and len(chunk) > 1:
+                    _chain.rpc_batch_size = max(len(chunk) // 2, 1)
+                    warning(f'Batch of {len(chunk)} requests is too large, reducing batches to {_chain.rpc_batch_size} requests')
+                    continue
+                # Only this batch is repeated by single calls
+                warning(f'Batch of {len(chunk)} requests is rejected ({e}), repeating them as single calls')
+                failed.extend(range(start, start + len(chunk)))
+                start += len(chunk)
+                continue
+            for i, response in enumerate(responses, start):
+                if response is None or 'error' in response or not 'result' in response:
+                    failed.append(i)
+                else:
+                    results[i] = response['result']
+            start += len(chunk)
+    for i in failed:
+        try:
+            results[i] = make_web3_call(make_rpc_request, _chain, *_calls[i])
+        except Exception as e:
+            error(f'{_calls[i][0]} failed for {_calls[i][1]}')
+            results[i] = e
+    return results
+
+# Returns the head block, the number of the last finalized block and the block the chain
+# is forked from if the latest block scanned in the low-latency mode is orphaned. The finalized
+# block is the block with FINALITY_TAG if the RPC provider supports the tag, otherwise it is
+# FINALIZATION_INTERVAL blocks behind the head. All blocks are requested in one batch
+def get_chain_tip(_chain):
+    # The provider could be upgraded or replaced by another endpoint of the pool
+    if not _chain.finality_tag_supported and _chain.FINALITY_TAG and monotonic() >= _chain.finality_tag_probe_at:
+        _chain.finality_tag_supported = True
+    calls = [('eth_getBlockByNumber', ['latest', False])]
+    if _chain.finality_tag_supported:
+        calls.append(('eth_getBlockByNumber', [_chain.FINALITY_TAG, False]))
+    if len(_chain.scanned_blocks) > 0:
+        latest_scanned = next(reversed(_chain.scanned_blocks))
+        calls.append(('eth_getBlockByNumber', [hex(latest_scanned), False]))
+    blocks = make_web3_batch_call(_chain, calls)
+    if isinstance(blocks[0], Exception):
+        raise blocks[0]
+    head_block = blocks[0]
+    finalized_block = int(head_block['number'], 16) - _chain.FINALIZATION_INTERVAL
+    if _chain.finality_tag_supported:
+        # Other errors are transient, the cycle is repeated with the tag
+        if isinstance(blocks[1], Exception) and not is_unsupported_tag_error(blocks[1]):
+            raise blocks[1]
+        if isinstance(blocks[1], Exception) or blocks[1] is None:
+            warning(f'RPC provider does not support "{_chain.FINALITY_TAG}" block tag, FINALIZATION_INTERVAL is used instead')
+            _chain.finality_tag_supported = False
+            _chain.finality_tag_probe_at = monotonic() + FINALITY_TAG_PROBE_INTERVAL
+        else:
+            finalized_block = int(blocks[1]['number'], 16)
+    fork_block = None
+    if len(_chain.scanned_blocks) > 0:
+        # If the latest scanned block is still in the chain, all scanned blocks before it are too
+        if not isinstance(blocks[-1], Exception) and \
+           (blocks[-1] is None or blocks[-1]['hash'] != _chain.scanned_blocks[latest_scanned]):
+            fork_block = find_fork_block(_chain, finalized_block)
+    return head_block, finalized_block, fork_block
+
+# Checks if the block was not returned because the RPC provider does not know the block tag:
+# the tag is refused as an invalid parameter or the error message tells it explicitly
+def is_unsupported_tag_error(_exc):
+    if is_rate_limit_error(_exc):
+        return False
+    rpc_error = _exc.args[0] if _exc.args and isinstance(_exc.args[0], dict) else {}
+    if rpc_error.get('code') == -32602:
+        return True
+    message = str(rpc_error.get('message', _exc)).lower()
+    return any(pattern in message for pattern in UNSUPPORTED_TAG_ERRORS)
+
+# Returns the latest block scanned in the low-latency mode which is still in the chain.
+# If all scanned blocks are orphaned, the chain is forked not later than the finalized block
+def find_fork_block(_chain, _finalized_block):
+    numbers = list(_chain.scanned_blocks)
+    blocks = make_web3_batch_call(_chain, [('eth_getBlockByNumber', [hex(number), False]) for number in numbers])
+    fork_block = min(_finalized_block, numbers[0] - 1)
+    for number, block in zip(numbers, blocks):
+        if isinstance(block, Exception):
+            raise block
+        if block is not None and block['hash'] == _chain.scanned_blocks[number]:
+            fork_block = number
+    return fork_block
+
+# Undoes the blocks orphaned by a reorg: rewards known as mined in these blocks are
+# checked again and reward attempts recorded in these blocks are moved to the fork block
+def undo_orphaned_blocks(_chain, _fork_block, _handled_index):
+    warning(f'Blocks after {_fork_block} are orphaned by a reorg')
+    reorgs.labels(_chain.name).inc()
+    for number in [number for number in _chain.scanned_blocks if number > _fork_block]:
+        del _chain.scanned_blocks[number]
+    for txhash in [txhash for txhash, block in _chain.mined_txs.items() if block > _fork_block]:
+        del _chain.mined_txs[txhash]
+    _handled_index.rewind(_fork_block)
+    _chain.history_storage.rewind_history(_fork_block)
+
+# Remembers the hash of the last block of the range scanned in the low-latency mode
+# to detect a reorg on the next cycle. Hashes of finalized blocks are not needed anymore
+def remember_scanned_block(_chain, _block, _head_block, _finalized_block):
+    for number in [number for number in _chain.scanned_blocks if number <= _finalized_block]:
+        del _chain.scanned_blocks[number]
+    if _block <= _finalized_block:
+        return
+    if _block == int(_head_block['number'], 16):
+        block_hash = _head_block['hash']
+    else:
+        block_hash = make_web3_call(make_rpc_request, _chain, 'eth_getBlockByNumber', [hex(_block), False])['hash']
+    _chain.scanned_blocks[_block] = block_hash
+
 # Returns range of blocks to look for events.
-# Default limit finishes by the last finalized block and starts
-# HISTORY_BLOCK_RANGE block lower
-def get_observation_range(_previous_last_block):
-    last_block = make_web3_call(plg_w3.eth.getBlock, 'latest').number
-    last_block = last_block - FINALIZATION_INTERVAL
+# Default limit finishes by the last finalized block (or LOW_LATENCY_INTERVAL blocks
+# behind the head in the low-latency mode) and starts HISTORY_BLOCK_RANGE block lower.
+# After downtime the range covers blocks missed since the previous run but not more than
+# CATCHUP_BLOCK_RANGE of them. The third item is the block the range would finish by without
+# the limit, the tip of the chain
+def get_observation_range(_chain, _previous_last_block, _head, _finalized_block):
+    head_lag.labels(_chain.name).set(_head - _previous_last_block)
+    last_block = _finalized_block
+    if _chain.LOW_LATENCY_INTERVAL >= 0:
+        last_block = max(_head - _chain.LOW_LATENCY_INTERVAL, _finalized_block)
+    tip_block = last_block
+    if _chain.head_subscriber is not None:
+        _chain.head_subscriber.set_finality_lag(_head - tip_block)
     if _previous_last_block > last_block:
         BaseException("Last block received from RPC is less than last revisited block")
-    # If the previous block is outside of range that allowed by the RPC provider
-    # it is necessary to reduce the right limit of the lookup range 
-    if (_previous_last_block + 1 + RPC_LIMIT_BLOCK_RANGE) < last_block:
+    # If the previous block is too far in the past it is necessary
+    # to reduce the right limit of the lookup range 
+    if _chain.CATCHUP_BLOCK_RANGE > 0 and (_previous_last_block + 1 + _chain.CATCHUP_BLOCK_RANGE) < last_block:
         start_block = _previous_last_block + 1
-        last_block = _previous_last_block + 1 + RPC_LIMIT_BLOCK_RANGE
+        last_block = _previous_last_block + 1 + _chain.CATCHUP_BLOCK_RANGE
     else:
         # If the previous block is lower the default range, extende the range to explore 
         # events in the blocks after the previous block
-        if last_block - (_previous_last_block + 1) > HISTORY_BLOCK_RANGE:
+        if last_block - (_previous_last_block + 1) > _chain.HISTORY_BLOCK_RANGE:
             start_block = _previous_last_block + 1
         else:
-            start_block = last_block - HISTORY_BLOCK_RANGE
+            start_block = last_block - _chain.HISTORY_BLOCK_RANGE
     info(f'Suggested range of blocks: {start_block} - {last_block}')
-    return start_block, last_block
-
-# Parse a transaction log and extract a recipient of BOB tokens
-# if value of the transfer is less the threshold recipient will be discarded
-def process_event(_token, _event):
-    pl = _token['handler'](_event)
-    recipient = pl.args['to']
-    value = pl.args['value']
-    if value >= Web3.toWei(WITHDRAWAL_THRESHOLD, "ether"):
-        return recipient
-    else:
-        return None
+    return start_block, last_block, tip_block
+
+# Parse transaction logs and extract recipients of BOB tokens
+# if value of the transfer is less the threshold recipient will be discarded.
+# Logs are not decoded by the ABI: the recipient is the last 20 bytes of the third topic
+# and the value is the only data word, so no objects are built for discarded transfers
+def process_events(_chain, _events):
+    recipients = set()
+    for event in _events:
+        if int(event['data'], 16) >= _chain.withdrawal_threshold:
+            recipients.add(event['topics'][2][-40:])
+    return set([Web3.toChecksumAddress('0x' + recipient) for recipient in recipients])
+
+# Checks if eth_getLogs failed because the range of blocks is too wide for the RPC provider
+def is_logs_range_error(_exc):
+    # Messages about the rate limit look like the ones about the range limit
+    if is_rate_limit_error(_exc):
+        return False
+    message = str(_exc.args[0].get('message', _exc) if _exc.args and isinstance(_exc.args[0], dict) else _exc).lower()
+    return any(pattern in message for pattern in LOGS_RANGE_ERRORS)
+
+# Requests Transfer events from the range of blocks. If the RPC provider refuses to
+# serve the range, it is split by smaller chunks which are requested one after another.
+# Raw logs are returned since web3 formatters are too expensive for big ranges
+def get_logs_adaptively(_chain, _from_block, _to_block):
+    params = [{'fromBlock': hex(_from_block), 
+               'toBlock': hex(_to_block), 
+               'address': _chain.token['efilter'].address, 
+               'topics': _chain.token['efilter'].topics}]
+    try:
+        events = make_web3_call_with_exceptions(make_rpc_request, [ValueError], _chain, 'eth_getLogs', params)
+    except ValueError as ve:
+        if _to_block <= _from_block or not is_logs_range_error(ve):
+            # Other JSON-RPC errors are not caused by the range, the request is repeated as is
+            warning(f'Range {_from_block} - {_to_block} is not served by RPC ({ve}), repeating the request')
+            events = make_web3_call(make_rpc_request, _chain, 'eth_getLogs', params)
+            grow_logs_chunk_size(_chain)
+            return events
+        # Next ranges will be requested by smaller chunks from the very beginning
+        _chain.logs_chunk_size = min(_chain.logs_chunk_size, (_to_block - _from_block) // 2)
+        _chain.logs_chunk_successes = 0
+        chunk_size = _chain.logs_chunk_size
+        warning(f'Range {_from_block} - {_to_block} is refused by RPC ({ve}), splitting by {chunk_size + 1} blocks')
+        events = []
+        for start in range(_from_block, _to_block + 1, chunk_size + 1):
+            events += get_logs_adaptively(_chain, start, min(start + chunk_size, _to_block))
+        return events
+    grow_logs_chunk_size(_chain)
+    return events
+
+# The chunk size reduced by a dense range of blocks is doubled after LOGS_CHUNK_GROWTH_SUCCESSES
+# successful requests in a row, so sparse ranges are not requested by small chunks forever
+def grow_logs_chunk_size(_chain):
+    if _chain.logs_chunk_size >= _chain.RPC_LIMIT_BLOCK_RANGE:
+        return
+    _chain.logs_chunk_successes += 1
+    if _chain.logs_chunk_successes >= LOGS_CHUNK_GROWTH_SUCCESSES:
+        _chain.logs_chunk_successes = 0
+        _chain.logs_chunk_size = min(_chain.logs_chunk_size * 2 + 1, _chain.RPC_LIMIT_BLOCK_RANGE)
 
 # Recives Transfer events from the range of blocks and returns list of BOB token recipients with
 # transfer values above threshold
-def get_recipients(_token, _from_block, _to_block):
-    event_name = _token['efilter'].event_abi['name']
+# The range is split by chunks acceptable by the RPC provider which are requested concurrently
+def get_recipients(_chain, _from_block, _to_block):
+    event_name = _chain.token['efilter'].event_abi['name']
     info(f'Looking for {event_name} events on BOB token from {_from_block} to {_to_block}')
-    events = make_web3_call(_token['cnt'].web3.eth.getLogs, {'fromBlock': _from_block, 
-                                                             'toBlock': _to_block, 
-                                                             'address': _token['efilter'].address, 
-                                                             'topics': _token['efilter'].topics})
-    len_events = len(events)
-    info(f"Found {len_events} of {event_name} events")
-    if len_events > 0:
-        recipients = set([process_event(_token, e) for e in events])
-        recipients.discard(None)
-    else:
-        recipients = set()
+    chunks = [(start, min(start + _chain.logs_chunk_size, _to_block)) 
+              for start in range(_from_block, _to_block + 1, _chain.logs_chunk_size + 1)]
+    with ThreadPoolExecutor(max_workers=max(min(LOGS_SCAN_WORKERS, len(chunks)), 1), 
+                            thread_name_prefix=_chain.name) as executor:
+        chunked_events = list(executor.map(lambda chunk: get_logs_adaptively(_chain, *chunk), chunks))
+    len_events = sum([len(chunk_events) for chunk_events in chunked_events])
+    info(f"Found {len_events} of {event_name} events in {len(chunks)} chunks")
+    recipients = set()
+    for chunk_events in chunked_events:
+        recipients.update(process_events(_chain, chunk_events))
     info(f'Identified {len(recipients)} tokens recipients from BOB token events')
 
     return recipients
 
+# Checks if the transaction was confirmed as mined successfully before
+def is_tx_known_as_mined(_chain, _txhash):
+    if _txhash in _chain.mined_txs:
+        _chain.mined_txs.move_to_end(_txhash)
+        return True
+    return False
+
+# Remembers the successfully mined transaction in order not to request its receipt again
+def remember_mined_tx(_chain, _txhash, _block):
+    _chain.mined_txs[_txhash] = _block
+    _chain.mined_txs.move_to_end(_txhash)
+    while len(_chain.mined_txs) > RECEIPT_CACHE_SIZE:
+        _chain.mined_txs.popitem(last=False)
+
 # Returns the list of recipients discovered in the past but with unsucessfull rewards
-def revisit_previous_rewards(handled_recipients, observation_range):
+def revisit_previous_rewards(_chain, handled_index, observation_range):
     # Discover transactions with rewards made in the past.
     # The range of blocks where reward attempts were made is
     # limited by HISTORY_BLOCK_RANGE + BLOCKS_TO_WAIT_BEFORE_RETRY earlier the last block 
     # from left side and BLOCKS_TO_WAIT_BEFORE_RETRY earlier the last block from the right side
-    accounts_to_check = {}
-    for block in list(handled_recipients.keys()):
-        if int(block) >= observation_range[1] - (HISTORY_BLOCK_RANGE + BLOCKS_TO_WAIT_BEFORE_RETRY):
-            if int(block) < observation_range[1] - BLOCKS_TO_WAIT_BEFORE_RETRY:
-                for account in handled_recipients[block]:
-                    if not account in accounts_to_check:
-                        accounts_to_check[account] = []
-                    # Since the same account can be tried to be rewarded several times
-                    # collect transactions of all attempts
-                    accounts_to_check[account].append(handled_recipients[block][account])
-        else:
-            del handled_recipients[block]
+    # Older attempts are not needed anymore
+    min_block = observation_range[1] - (_chain.HISTORY_BLOCK_RANGE + _chain.BLOCKS_TO_WAIT_BEFORE_RETRY)
+    handled_index.evict_before(min_block)
+    _chain.history_storage.prune_history(min_block)
+    # Since the same account can be tried to be rewarded several times
+    # transactions of all attempts are collected
+    accounts_to_check = handled_index.attempts_between(min_block, observation_range[1] - _chain.BLOCKS_TO_WAIT_BEFORE_RETRY)
     info(f'Identified {len(accounts_to_check)} candidates to check sent rewards')
 
-    candidates_for_retry = set()
-    for account in accounts_to_check:
-        reward_sent = False
-        # Check all the transactions made for the account
-        # If at least one transaction is successfull, don't include
-        # the account for re-try attemtps
-        for txhash in accounts_to_check[account]:
+    # Check all the transactions made for the account
+    # If at least one transaction is successfull, don't include
+    # the account for re-try attemtps
+    # The latest attempts are checked first since they are most likely mined,
+    # earlier attempts of an account are checked only if the later ones are not mined
+    # Rewards which are still pending are replaced by the watchers with the same nonces.
+    # Sending them again with new nonces could reward the same account twice
+    pending_recipients = set([Web3.toChecksumAddress(recipient) for watcher in _chain.tx_watchers.values() 
+                              for tx in watcher.pending.values() for recipient in tx['recipients']])
+    unconfirmed = {}
+    for account, txhashes in accounts_to_check.items():
+        if any(is_tx_known_as_mined(_chain, txhash) for txhash in txhashes):
+            info(f'Reward to {account} is already known as mined')
+        elif Web3.toChecksumAddress(account) in pending_recipients:
+            info(f'Reward to {account} is still pending')
+        else:
+            unconfirmed[account] = list(reversed(txhashes))
+    attempt = 0
+    while len(unconfirmed) > 0:
+        to_check = [(account, txhashes[attempt]) for account, txhashes in unconfirmed.items() 
+                    if attempt < len(txhashes)]
+        if len(to_check) == 0:
+            break
+        receipts = make_web3_batch_call(_chain, [('eth_getTransactionReceipt', [txhash]) for _, txhash in to_check])
+        for (account, txhash), rcpt in zip(to_check, receipts):
             info(f'Check status of tx {txhash} sent to reward {account}')
-            try:
-                rcpt = make_web3_call_with_exceptions(plg_w3.eth.get_transaction_receipt, [TransactionNotFound], txhash)
-            except TransactionNotFound:
+            if isinstance(rcpt, Exception):
+                raise rcpt
+            if rcpt is None or rcpt.get('blockNumber') is None:
                 info(f'Tx {txhash} not found')
-            except Exception as e:
-                raise e
+            elif rcpt.get('status') != '0x1':
+                # Reverted rewards are not paid, the account is rewarded again
+                # unless an earlier attempt succeeded
+                warning(f'Tx {txhash} reverted')
             else:
                 info(f'Tx {txhash} mined sucessfully')
-                if rcpt.blockNumber:
-                    reward_sent = True
-        if not reward_sent:
-            candidates_for_retry.add(Web3.toChecksumAddress(account))
+                remember_mined_tx(_chain, txhash, int(rcpt['blockNumber'], 16))
+                del unconfirmed[account]
+        attempt += 1
+    candidates_for_retry = set([Web3.toChecksumAddress(account) for account in unconfirmed])
     info(f'Identified {len(candidates_for_retry)} accounts to re-send rewards')
             
     return candidates_for_retry
 
 # Filters out recipients to be rewarded
-def soap_recipients(_recipients, _handled_recipients, _observation_range):
-    # Get a list of recipients which were handled
-    # recently - not deeper than BLOCKS_TO_WAIT_BEFORE_RETRY 
-    handled_recently = set()
-    for block in list(_handled_recipients.keys()):
-        if int(block) >= _observation_range[1] - BLOCKS_TO_WAIT_BEFORE_RETRY:
-            handled_recently.update([account for account in _handled_recipients[block]])
-
-    # Open a cache with contracts used as recipients in the past
-    try:
-        with open(f'{JSON_DB_DIR}/{JSON_CONTRACTS}') as f:
-            contracts = load(f)
-    except IOError:
-        info("no contracts identified previously")
-        contracts = {}
+def soap_recipients(_chain, _recipients, _handled_index, _observation_range):
+    # Recipients which were handled recently - not deeper than BLOCKS_TO_WAIT_BEFORE_RETRY 
+    handled_recently_since = _observation_range[1] - _chain.BLOCKS_TO_WAIT_BEFORE_RETRY
 
     endowing = set()
     # Special case to add the facet address as the reward recipient to test transactions sending
-    if TEST_TO_SEND and not sending_tested:
-        endowing.append(faucet.address)
+    if TEST_TO_SEND and not _chain.sending_tested:
+        endowing.add(_chain.faucet.address)
         info(f'activated testmode to send a transaction')
-        sending_tested = True
+        _chain.sending_tested = True
 
-    contracts_cache_updated = False
     # Filter rules:
     # - recipient must not be a contract
     # - there is no attempts to send reward recent BLOCKS_TO_WAIT_BEFORE_RETRY blocks
     # - recipient's balance of native tokens is zero
+    # check if the contract by using the cache of contracts and EOAs
+    to_check_code = []
+    eoas = []
     for recipient in _recipients:
-        # check if the contract by using the cache
-        if recipient in contracts:
+        is_contract = _chain.code_cache.is_contract(recipient)
+        if is_contract is None:
+            to_check_code.append(recipient)
+        elif is_contract:
             info(f'{recipient} is contract. Skipping')
-            continue
-        # the address was not found in the cache, request the RPC provider
-        # The last block is used to make sure that RPC provider is synchronized: doesn't
-        # outdated provide data 
-        code = make_web3_call(plg_w3.eth.getCode, recipient, _observation_range[1])
-        if code != b'':
-            contracts[recipient] = True
-            contracts_cache_updated = True
+        else:
+            eoas.append(recipient)
+    # the addresses were not found in the cache, request the RPC provider by batches
+    # The last block is used to make sure that RPC provider is synchronized: doesn't
+    # outdated provide data 
+    block_tag = hex(_observation_range[1])
+    codes = make_web3_batch_call(_chain, [('eth_getCode', [recipient, block_tag]) for recipient in to_check_code])
+    for recipient, code in zip(to_check_code, codes):
+        if isinstance(code, Exception):
+            _chain.code_cache.flush()
+            raise code
+        is_contract = HexBytes(code) != b''
+        _chain.code_cache.add(recipient, is_contract)
+        if is_contract:
             info(f'{recipient} is contract. Skipping')
-            continue
+        else:
+            eoas.append(recipient)
+    _chain.code_cache.flush()
+    to_check_balance = []
+    for recipient in eoas:
         # check if there is not attempts to send reward recently
-        if recipient in handled_recently:
+        if _handled_index.handled_since(recipient, handled_recently_since):
             info(f'{recipient} has been handled recently. Skipping')
             continue
-        # check that the recipient's balance is zero
-        # The last block is used to make sure that RPC provider is synchronized: doesn't
-        # outdated provide data 
-        balance = make_web3_call(plg_w3.eth.getBalance, recipient, _observation_range[1])
-        if balance == 0 or recipient == faucet.address:
+        to_check_balance.append(recipient)
+    # check that the recipient's balance is zero
+    balances = make_web3_batch_call(_chain, [('eth_getBalance', [recipient, block_tag]) for recipient in to_check_balance])
+    for recipient, balance in zip(to_check_balance, balances):
+        if isinstance(balance, Exception):
+            raise balance
+        if int(balance, 16) == 0 or recipient == _chain.faucet.address:
             info(f'{recipient} balance is zero')
             endowing.add(recipient)
         else:
             info(f'Balance of {recipient} is not zero. Skipping')
     info(f'found {len(endowing)} accounts for reward')
-    
-    # Update the cache with contracts
-    if contracts_cache_updated:
-        with open(f'{JSON_DB_DIR}/{JSON_CONTRACTS}', 'w') as json_file:
-            dump(contracts, json_file)
-        
-    return endowing
 
-# Tries to predict gas price based on the choosen apporach
-def estimate_gas_price():    
-    if GAS_PRICE < 0:
-        # For Type 2 transactions
-        
-        # It makes sense to look at very last block rather than finalized block
-        last_block = make_web3_call(plg_w3.eth.getBlock, 'latest').number
-
-        fee_hist = make_web3_call(plg_w3.eth.fee_history, HISTORICAL_BASE_FEE_DEPTH, last_block, [5, 30])
+    return endowing
 
+# Max number of blocks RPC providers return by one eth_feeHistory request
+FEE_HISTORY_MAX_BLOCKS = 1024
+
+# Keeps the latest _size values sorted in order to get the median
+# and the sum in order to get the mean without iterating over the window
+class SlidingWindow:
+    def __init__(self, _size):
+        self.size = _size
+        self.values = deque()
+        self.sorted = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def push(self, _value):
+        self.values.append(_value)
+        insort(self.sorted, _value)
+        self.total += _value
+        if len(self.values) > self.size:
+            expired = self.values.popleft()
+            del self.sorted[bisect_left(self.sorted, expired)]
+            self.total -= expired
+
+    def median(self):
+        middle = len(self.sorted) // 2
+        if len(self.sorted) % 2 == 1:
+            return self.sorted[middle]
+        return (self.sorted[middle - 1] + self.sorted[middle]) / 2
+
+    def mean(self):
+        return self.total / len(self.values)
+
+# Keeps base fees and priority fees of HISTORICAL_BASE_FEE_DEPTH recent blocks.
+# Only blocks added since the previous update are requested from the RPC provider,
+# the estimation itself does not make any requests
+class FeeOracle:
+    def __init__(self, _chain):
+        self.chain = _chain
+        self.depth = _chain.HISTORICAL_BASE_FEE_DEPTH
+        self.last_block = None
+        self.base_fees = SlidingWindow(self.depth)
+        self.priority_fees = SlidingWindow(self.depth)
+
+    # Requests fee history of blocks after the last known block up to _head
+    def update(self, _head):
+        if self.last_block is not None and _head <= self.last_block:
+            return
+        first_block = _head - self.depth + 1
+        if self.last_block is not None:
+            first_block = max(first_block, self.last_block + 1)
+        while first_block <= _head:
+            newest_block = min(first_block + FEE_HISTORY_MAX_BLOCKS - 1, _head)
+            fee_hist = make_web3_call(self.chain.w3.eth.fee_history, newest_block - first_block + 1, newest_block, [5, 30])
+            # The last base fee is for the block after the newest one
+            for base_fee, rewards in zip(fee_hist.baseFeePerGas, fee_hist.reward):
+                self.base_fees.push(base_fee)
+                # Priority fee of a block is the mean of its percentiles
+                self.priority_fees.push(mean(rewards))
+            first_block = newest_block + 1
+        self.last_block = _head
+
+    def estimate(self):
         # Predict base fee by getting base fees of recent blocks
-        base_fee_hist = fee_hist.baseFeePerGas
-        historical_base_fee = max(int(median(base_fee_hist)), int(mean(base_fee_hist)))
+        historical_base_fee = max(int(self.base_fees.median()), int(self.base_fees.mean()))
         info(f'Base fee based on historical data: {Web3.fromWei(historical_base_fee, "wei")}')
 
         # Predict priority fee by getting mean of priority fees from every recent block
-        priority_fee = [ mean(i) for i in fee_hist.reward ]
-        recommended_priority_fee = min(int(mean(priority_fee)), int(median(priority_fee)))
+        recommended_priority_fee = min(int(self.priority_fees.mean()), int(self.priority_fees.median()))
+
+        max_gas_price = min(int(historical_base_fee * self.chain.BASE_FEE_RATIO) + recommended_priority_fee, 
+                            Web3.toWei(self.chain.FEE_LIMIT, 'gwei'))
+        return max_gas_price, recommended_priority_fee
 
-        max_gas_price = min(int(historical_base_fee * BASE_FEE_RATIO) + recommended_priority_fee, 
-                            Web3.toWei(FEE_LIMIT, 'gwei'))
+# Returns the number of the latest block. The block known from
+# the subscription to new blocks is used if it is available
+def get_head_block(_chain):
+    if _chain.head_subscriber is not None and _chain.head_subscriber.connected and _chain.head_subscriber.head is not None:
+        return _chain.head_subscriber.head
+    return make_web3_call(_chain.w3.eth.get_block_number)
+
+# Tries to predict gas price based on the choosen apporach
+# The head block known by the caller is used instead of requesting it again
+def estimate_gas_price(_chain, _head=None):    
+    if _chain.GAS_PRICE < 0:
+        # For Type 2 transactions
+        
+        # It makes sense to look at very last block rather than finalized block
+        _chain.fee_oracle.update(_head if _head is not None else get_head_block(_chain))
+
+        max_gas_price, recommended_priority_fee = _chain.fee_oracle.estimate()
         info(f'Suggested max fee per gas: {Web3.fromWei(max_gas_price, "gwei")}')
         info(f'Suggested priority fee per gas: {Web3.fromWei(recommended_priority_fee, "gwei")}')
     else:
         # For legacy transactions
-        max_gas_price = Web3.toWei(GAS_PRICE, 'gwei')
+        max_gas_price = Web3.toWei(_chain.GAS_PRICE, 'gwei')
         recommended_priority_fee = 0
         
     return max_gas_price, recommended_priority_fee
@@ -403,23 +1629,30 @@ def estimate_gas_price():
 # Adjusts gas price for the case if a transaction with the same nonce was already sent but stuck
 # by some reason. RPC providers expect a replacing transaction with higher gas price that was
 # in the existing one
-def adjust_gas_price(_current_gas_price, _previous_gas_price):
+def adjust_gas_price(_chain, _current_gas_price, _previous_gas_price):
     increased_max_gas_price = int(_previous_gas_price[0] * 1.1) + 1
     max_gas_price = min(max(_current_gas_price[0], increased_max_gas_price),
-                        Web3.toWei(FEE_LIMIT, 'gwei'))
+                        Web3.toWei(_chain.FEE_LIMIT, 'gwei'))
     if _previous_gas_price[1] != 0:
         increased_recommended_priority_fee = int(_previous_gas_price[1] * 1.1) + 1
-        recommended_priority_fee = max(_current_gas_price[1], 
-                                       increased_recommended_priority_fee)
+        # The priority fee cannot exceed max fee per gas
+        recommended_priority_fee = min(max(_current_gas_price[1], 
+                                           increased_recommended_priority_fee),
+                                       max_gas_price)
     else:
         recommended_priority_fee = 0
     return max_gas_price, recommended_priority_fee
 
+# Nodes accept a transaction replacing the pending one only if both its max fee per gas
+# and priority fee are at least 10% higher
+def is_replacement_priced(_gas_price, _previous_gas_price):
+    return all([new * 10 >= previous * 11 for new, previous in zip(_gas_price, _previous_gas_price)])
+
 # Sends signed transaction
 # Tries to handle RPC responses caused by traffic conjections or synchronization issues
-def sent_raw_transaction(_rawtx):
+def sent_raw_transaction(_chain, _raw_transaction, _tx_hash, _recipients):
     try:
-        sent_tx_hash = make_web3_call_with_exceptions(plg_w3.eth.sendRawTransaction, [ValueError], _rawtx.rawTransaction)
+        sent_tx_hash = make_web3_call_with_exceptions(_chain.w3.eth.sendRawTransaction, [ValueError], _raw_transaction)
     except ValueError as ve:
         ve_as_str = str(ve)
         try:
@@ -440,95 +1673,750 @@ def sent_raw_transaction(_rawtx):
                                    'replacement transaction underpriced', 
                                    'INTERNAL_ERROR: could not replace existing tx']:
                 raise ve
-            info(f'{recipient} marked as handled to evaluate reward re-sending later')
-            return Web3.toHex(_rawtx.hash)
+            for recipient in _recipients:
+                info(f'{recipient} marked as handled to evaluate reward re-sending later')
+            return Web3.toHex(_tx_hash)
     str_hash = Web3.toHex(sent_tx_hash)
-    info(f'{recipient} rewarded by {str_hash}')
+    for recipient in _recipients:
+        info(f'{recipient} rewarded by {str_hash}')
     return str_hash
 
-while True:
-    # If a stop files exists, stop the faucet.
-    # It will not work if the faucet is run within the docker
-    # with the option "restart: unless-stopped"
-    try:
-        with open(f'{JSON_DB_DIR}/{STOP_FILE}') as f:
-            info("Stopping faucet")
-            break
-    except IOError:
-        pass
-
-    previous_last_block, handled_recipients, nonces = get_storage_of_handled()
-
-    observation_range = get_observation_range(previous_last_block)
-
-    recipients = get_recipients(token, observation_range[0], observation_range[1])
+# Selector of disperseEther(address[] recipients, uint256[] values) of the disperse contract
+DISPERSE_ETHER_SELECTOR = Web3.keccak(text='disperseEther(address[],uint256[])')[:4]
+
+# Splits the recipients into batches rewarded by one transaction each. Without
+# DISPERSE_CONTRACT every recipient is rewarded by its own transaction, otherwise
+# batches are as big as DISPERSE_GAS_LIMIT allows
+def split_to_batches(_chain, _recipients):
+    if not _chain.DISPERSE_CONTRACT:
+        return [[recipient] for recipient in _recipients]
+    size = max((_chain.DISPERSE_GAS_LIMIT - _chain.GAS_LIMIT) // _chain.DISPERSE_GAS_PER_RECIPIENT, 1)
+    return [_recipients[i:i + size] for i in range(0, len(_recipients), size)]
+
+# Gas limit of the transaction rewarding the batch of recipients
+def reward_gas_limit(_chain, _recipients):
+    if len(_recipients) == 1:
+        return _chain.GAS_LIMIT
+    return _chain.GAS_LIMIT + len(_recipients) * _chain.DISPERSE_GAS_PER_RECIPIENT
+
+# Builds a transaction to send the reward with the nonce and the gas price. The only
+# recipient is rewarded directly, several recipients are rewarded by the disperse contract
+def build_reward_tx(_chain, _recipients, _nonce, _gas_price):
+    reward = Web3.toWei(_chain.REWARD, 'ether')
+    tx = {
+        'nonce': _nonce,
+        'gas': reward_gas_limit(_chain, _recipients),
+        'chainId': _chain.chain_id,
+    }
+    if len(_recipients) == 1:
+        tx['data'] = b'Rewarded for zkBOB withdrawal'
+        tx['value'] = reward
+        tx['to'] = _recipients[0]
+    else:
+        tx['data'] = DISPERSE_ETHER_SELECTOR + encode_abi(['address[]', 'uint256[]'], 
+                                                          [_recipients, [reward] * len(_recipients)])
+        tx['value'] = reward * len(_recipients)
+        tx['to'] = _chain.DISPERSE_CONTRACT
+    if _chain.GAS_PRICE < 0:
+        tx['maxFeePerGas'] = _gas_price[0]
+        tx['maxPriorityFeePerGas'] = _gas_price[1]
+    else:
+        tx['gasPrice'] = _gas_price[0]
+    return tx
+
+# Sends rewards to all batches of recipients from the faucet account with the nonces.
+# Nonces are assigned locally, transactions are signed by chunks of BROADCAST_WORKERS
+# and every chunk is broadcasted concurrently while the next one is signed. Signing is
+# CPU bound and holds the GIL, so it only overlaps the network waits of the broadcasts.
+# Every transaction is tracked by the watcher of the account, the transactions not accepted
+# by the RPC provider are broadcasted again by the watcher since they block the following nonces.
+# Returns nonce, recipients, gas price and hash for every signed transaction
+def send_rewards(_chain, _account, _batches, _tx_nonces, _gas_price, _nonces, _block):
+    txs = []
+    for nonce, recipients in zip(_tx_nonces, _batches):
+        # if exists a record in the gas price history log it means that the faucet
+        # already tried to send a transaction with the same nonce
+        # in order to avoid getting 'replacement transaction underpriced' RPC error
+        # it is necessary to adjust the estimated gas price
+        tx_gas_price = _gas_price
+        if str(nonce) in _nonces:
+            tx_gas_price = adjust_gas_price(_chain, _gas_price, _nonces[str(nonce)])
+        txs.append((recipients, nonce, tx_gas_price, build_reward_tx(_chain, recipients, nonce, tx_gas_price)))
+
+    def broadcast(_recipients, _nonce, _rawtx):
+        try:
+            return sent_raw_transaction(_chain, _rawtx.rawTransaction, _rawtx.hash, _recipients)
+        except Exception as e:
+            error(f'Reward to {", ".join(_recipients)} with nonce {_nonce} was not sent: {e}')
+            return None
+
+    chunk_size = max(BROADCAST_WORKERS, 1)
+    rawtxs = []
+    broadcasts = []
+    with ThreadPoolExecutor(max_workers=max(min(chunk_size, len(txs)), 1), 
+                            thread_name_prefix=_chain.name) as executor:
+        for i in range(0, len(txs), chunk_size):
+            chunk = txs[i:i + chunk_size]
+            signed = [_account.signTransaction(tx) for _, _, _, tx in chunk]
+            # Transactions are journaled as attempts made in the _block before they are broadcasted
+            _chain.journal.append([journal_entry(_account, nonce, recipients, rawtx, tx_gas_price, _block) 
+                                   for (recipients, nonce, tx_gas_price, _), rawtx in zip(chunk, signed)])
+            rawtxs.extend(signed)
+            broadcasts.extend([executor.submit(broadcast, recipients, nonce, rawtx) 
+                               for (recipients, nonce, _, _), rawtx in zip(chunk, signed)])
+        sent_tx_hashes = [future.result() for future in broadcasts]
+
+    watcher = _chain.tx_watchers[_account.address]
+    sent = []
+    for (recipients, nonce, tx_gas_price, _), rawtx, sent_tx_hash in zip(txs, rawtxs, sent_tx_hashes):
+        _nonces[str(nonce)] = list(tx_gas_price)
+        if sent_tx_hash is None:
+            watcher.track(nonce, recipients, Web3.toHex(rawtx.hash), tx_gas_price, rawtx.rawTransaction)
+        else:
+            watcher.track(nonce, recipients, sent_tx_hash, tx_gas_price)
+        sent.append((nonce, recipients, tx_gas_price, watcher.pending[nonce]['hash']))
+    return sent
+
+# Spreads recipients among the faucet accounts by a stable hash of the recipient address,
+# so a reward to the same recipient is always sent from the same account
+def assign_to_faucets(_chain, _recipients):
+    shards = {}
+    for recipient in _recipients:
+        account = _chain.faucets[int.from_bytes(Web3.keccak(hexstr=recipient), 'big') % len(_chain.faucets)]
+        shards.setdefault(account.address, (account, []))[1].append(recipient)
+    return list(shards.values())
+
+# Requests balances of all faucet accounts by one batch and updates their metrics.
+# Returns the balances by addresses of the accounts
+def get_faucet_balances(_chain):
+    results = make_web3_batch_call(_chain, [('eth_getBalance', [account.address, 'latest']) for account in _chain.faucets])
+    balances = {}
+    for account, result in zip(_chain.faucets, results):
+        if isinstance(result, Exception):
+            raise result
+        balances[account.address] = int(result, 16)
+        info(f'faucet {account.address} balance: {balances[account.address]}')
+        faucet_balance_wei.labels(_chain.name, account.address).set(balances[account.address])
+    return balances
+
+# Sends rewards to the recipients from the faucet account if it has enough funds
+# Returns the starting nonce and the sent transactions or None if the balance is not enough
+def reward_by_faucet(_chain, _account, _recipients, _gas_price, _nonces, _block, _balance):
+    batches = split_to_batches(_chain, _recipients)
+    # Check if the faucet has enough funds to pay for gas and the value of all rewards assigned to it,
+    # a batch transfers the reward to every its recipient
+    reward = Web3.toWei(_chain.REWARD, 'ether')
+    if _balance <= sum([reward_gas_limit(_chain, batch) * _gas_price[0] + reward * len(batch) for batch in batches]):
+        error(f'not enough balance on the faucet {_account.address}')
+        return None
 
-    recipients.update(revisit_previous_rewards(handled_recipients, observation_range))
+    mined_nonce = make_web3_call(_chain.w3.eth.getTransactionCount, _account.address, 'latest')
+    # Since a new nonce received remove old records from the gas prices history log
+    for existing_nonce in list(_nonces):
+        if int(existing_nonce) < mined_nonce:
+            del _nonces[existing_nonce]
+    # Rewards sent in previous cycles can be still pending. New rewards follow them
+    # instead of replacing them by transactions with the same nonces
+    if len(batches) < len(_recipients):
+        info(f'{len(_recipients)} recipients are packed into {len(batches)} transactions')
+    # Nonces are assigned and the transactions are tracked before other pools sharing the account send theirs
+    sender = _chain.senders[_account.address]
+    with sender['lock']:
+        pending_nonce = make_web3_call(_chain.w3.eth.getTransactionCount, _account.address, 'pending')
+        tx_nonces = free_nonces(sender['watchers'], pending_nonce, len(batches))
+        info(f'{_account.address} starting nonce: {tx_nonces[0]}')
+        return mined_nonce, send_rewards(_chain, _account, batches, tx_nonces, _gas_price, _nonces, _block)
+
+# Records gas prices and hashes of the transactions sent from the faucet account
+def record_sent_rewards(_chain, _account, _nonce, _txs, _update_for_handled_recipients):
+    _chain.history_storage.prune_nonces(_account.address, _nonce)
+    for nonce, recipients, gas_price, tx_hash in _txs:
+        # Store values for gas price used in the transaction with the nonce even if it was not sent
+        # since the RPC provider could get it anyway
+        _chain.history_storage.store_nonce(_account.address, nonce, gas_price)
+        # Every recipient of the batch is recorded as handled by the same transaction,
+        # the transaction which was not sent yet is broadcasted again by the watcher
+        for recipient in recipients:
+            _update_for_handled_recipients[recipient] = tx_hash
+
+# Tracks reward transactions sent by the faucet until they are mined.
+# If a transaction is not mined for STUCK_TX_BLOCKS blocks it is replaced by
+# the transaction with the same nonce and recipients but with increased gas price.
+# Transactions not accepted by the RPC provider are broadcasted again on every check
+class PendingTxWatcher:
+    def __init__(self, _chain, _account):
+        self.chain = _chain
+        self.account = _account
+        # nonce -> the latest transaction sent with the nonce
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    # _raw is the signed transaction if it was not accepted by the RPC provider
+    def track(self, _nonce, _recipients, _tx_hash, _gas_price, _raw=None):
+        # The block the transaction is sent in is set on the first check
+        self.pending[_nonce] = {'recipients': _recipients, 'hash': _tx_hash, 
+                                'gas_price': list(_gas_price), 'block': None, 'raw': _raw}
+        pending_txs.labels(self.chain.name, self.account.address).set(len(self.pending))
+
+    # Broadcasts again the transactions which were not accepted by the RPC provider,
+    # the following nonces cannot be mined until they are
+    def resend_unsent(self):
+        for nonce, tx in sorted(self.pending.items()):
+            if tx['raw'] is None:
+                continue
+            try:
+                sent_raw_transaction(self.chain, tx['raw'], HexBytes(tx['hash']), tx['recipients'])
+            except Exception as e:
+                error(f'Reward to {", ".join(tx["recipients"])} with nonce {nonce} was not sent again: {e}')
+                continue
+            tx['raw'] = None
+
+    # Forgets mined transactions and replaces the stuck ones. The replacing transactions
+    # are recorded as reward attempts made in the _head block
+    def check(self, _head, _last_block, _handled_index, _nonces):
+        for tx in self.pending.values():
+            if tx['block'] is None:
+                tx['block'] = _head
+        mined_nonce = make_web3_call(self.chain.w3.eth.getTransactionCount, self.account.address, 'latest')
+        for nonce in [nonce for nonce in self.pending if nonce < mined_nonce]:
+            del self.pending[nonce]
+        pending_txs.labels(self.chain.name, self.account.address).set(len(self.pending))
+        self.resend_unsent()
+        stuck = sorted([nonce for nonce, tx in self.pending.items() if _head - tx['block'] >= self.chain.STUCK_TX_BLOCKS])
+        if len(stuck) == 0:
+            return
+        info(f'{len(stuck)} transactions from {self.account.address} are not mined for {self.chain.STUCK_TX_BLOCKS} blocks, first stuck nonce: {stuck[0]}')
+        gas_price = estimate_gas_price(self.chain)
+        replaced = {}
+        for nonce in stuck:
+            tx = self.pending[nonce]
+            # The gas price log keeps the highest gas price used with the nonce
+            previous_gas_price = _nonces.get(str(nonce), tx['gas_price'])
+            new_gas_price = adjust_gas_price(self.chain, gas_price, previous_gas_price)
+            # The node would reject the replacement as underpriced
+            if not is_replacement_priced(new_gas_price, previous_gas_price):
+                warning(f'Cannot increase gas price for nonce {nonce} by 10% without exceeding FEE_LIMIT')
+                tx['block'] = _head
+                continue
+            rawtx = self.account.signTransaction(build_reward_tx(self.chain, tx['recipients'], nonce, new_gas_price))
+            self.chain.journal.append([journal_entry(self.account, nonce, tx['recipients'], rawtx, new_gas_price, _head)])
+            try:
+                tx_hash = sent_raw_transaction(self.chain, rawtx.rawTransaction, rawtx.hash, tx['recipients'])
+            except Exception as e:
+                error(f'Replacement of tx with nonce {nonce} was not sent: {e}')
+                continue
+            info(f'Tx with nonce {nonce} replaced by {tx_hash} with max fee per gas {Web3.fromWei(new_gas_price[0], "gwei")}')
+            _nonces[str(nonce)] = list(new_gas_price)
+            self.chain.history_storage.store_nonce(self.account.address, nonce, new_gas_price)
+            self.pending[nonce] = {'recipients': tx['recipients'], 'hash': tx_hash, 
+                                   'gas_price': list(new_gas_price), 'block': _head, 'raw': None}
+            for recipient in tx['recipients']:
+                replaced[recipient] = tx_hash
+        if len(replaced) > 0:
+            # Previous attempts are kept in the history since they still can be mined
+            _handled_index.add(_head, replaced)
+            self.chain.history_storage.add_attempts(_head, replaced)
+            self.chain.history_storage.commit(_last_block)
+            self.chain.journal.clear()
+
+# Returns _count nonces starting from _pending_nonce which are not used by transactions tracked
+# by the watchers. Gaps left by transactions the faucet does not track anymore are filled first
+def free_nonces(_watchers, _pending_nonce, _count):
+    nonces = []
+    nonce = _pending_nonce
+    while len(nonces) < _count:
+        if not any([nonce in watcher.pending for watcher in _watchers]):
+            nonces.append(nonce)
+        nonce += 1
+    return nonces
+
+# Pools on the same chain can be configured with the same faucet account. Rewards from such
+# an account are sent by one pool at a time and nonces tracked by all pools are skipped:
+# (chain id, address) -> lock and watchers of the account
+faucet_senders = {}
+faucet_senders_lock = Lock()
+
+def register_faucet_sender(_chain_id, _watcher):
+    with faucet_senders_lock:
+        sender = faucet_senders.setdefault((_chain_id, _watcher.account.address), {'lock': Lock(), 'watchers': []})
+        sender['watchers'].append(_watcher)
+    return sender
+
+# Number of reward transactions which are not mined yet
+def count_pending_txs(_chain):
+    return sum([len(watcher) for watcher in _chain.tx_watchers.values()])
+
+# Waits for the next cycle of the main loop: until POLLING_INTERVAL expires or, if the
+# faucet is subscribed to new blocks, until a new block with BOB transfers is finalized.
+# Meanwhile pending reward transactions are checked on every new block or every
+# STUCK_TX_CHECK_INTERVAL seconds if there is no subscription to new blocks
+def wait_for_next_cycle(_chain, _last_block, _handled_index, _nonces):
+    deadline = monotonic() + POLLING_INTERVAL
+    # Pending transactions are checked by blocks received after the cycle
+    known_head = _chain.head_subscriber.head if _chain.head_subscriber is not None else None
+    while monotonic() < deadline:
+        remaining = deadline - monotonic()
+        if _chain.head_subscriber is not None and _chain.head_subscriber.connected:
+            if _chain.head_subscriber.scan_needed(_last_block):
+                info(f'Block {_chain.head_subscriber.head} finalizes new blocks, starting a new cycle')
+                return
+            head = _chain.head_subscriber.wait_for_head(known_head, remaining)
+            # No new blocks or the subscription dropped
+            if head is None:
+                continue
+            known_head = head
+        else:
+            sleep(min(remaining, STUCK_TX_CHECK_INTERVAL))
+            if count_pending_txs(_chain) == 0:
+                continue
+            head = get_head_block(_chain)
+        check_pending_txs(_chain, head, _last_block, _handled_index, _nonces)
+
+# Checks pending transactions of all faucet accounts by the _head block
+def check_pending_txs(_chain, _head, _last_block, _handled_index, _nonces):
+    for sender, watcher in _chain.tx_watchers.items():
+        if len(watcher) == 0:
+            continue
+        try:
+            watcher.check(_head, _last_block, _handled_index, _nonces[sender])
+        except Exception as e:
+            error(f'Not able to check pending transactions from {sender}: {e}')
+
+# Settings which can be specified for every chain in CHAINS_CONFIG.
+# If a setting is not specified for the chain, the value from the environment is used
+CHAIN_SETTINGS = {
+    'ZKBOB_RPC': str,
+    'ZKBOB_WS_RPC': str,
+    'RPC_LIMIT_BLOCK_RANGE': int,
+    'HISTORY_BLOCK_RANGE': int,
+    'CATCHUP_BLOCK_RANGE': int,
+    'BLOCKS_TO_WAIT_BEFORE_RETRY': int,
+    'BOB_TOKEN': str,
+    'POOL_CONTRACT': str,
+    'WITHDRAWAL_THRESHOLD': float,
+    'FAUCET_PRIVKEY': str,
+    'GAS_PRICE': float,
+    'HISTORICAL_BASE_FEE_DEPTH': int,
+    'BASE_FEE_RATIO': float,
+    'FEE_LIMIT': float,
+    'GAS_LIMIT': int,
+    'REWARD': float,
+    'DISPERSE_CONTRACT': str,
+    'DISPERSE_GAS_PER_RECIPIENT': int,
+    'DISPERSE_GAS_LIMIT': int,
+    'STUCK_TX_BLOCKS': int,
+    'INITIAL_START_BLOCK': int,
+    'FINALIZATION_INTERVAL': int,
+    'FINALITY_TAG': str,
+    'LOW_LATENCY_INTERVAL': int,
+    'JSON_HISTORY': str,
+    'SQLITE_HISTORY': str,
+    'JSON_CONTRACTS': str,
+    'SEND_JOURNAL': str,
+    'CODE_CACHE': str,
+    'RPC_BATCH_SIZE': int,
+}
 
-    endowing = soap_recipients(recipients, handled_recipients, observation_range)
+# Files of the history which are kept separately for every chain
+CHAIN_FILES = ['JSON_HISTORY', 'SQLITE_HISTORY', 'JSON_CONTRACTS', 'SEND_JOURNAL', 'CODE_CACHE']
+
+# Faucet accounts are shared by all chains using the same private key
+faucet_accounts = {}
+
+def get_faucet_account(_privkey):
+    if not _privkey in faucet_accounts:
+        faucet_accounts[_privkey] = Account.privateKeyToAccount(_privkey)
+    return faucet_accounts[_privkey]
+
+# A pool on a chain watched by the faucet: its settings, the connection to RPC providers,
+# the faucet accounts and the history of rewards. Settings are available as attributes
+# named as the corresponding environment variables
+class Chain:
+    def __init__(self, _name, _settings):
+        self.name = _name
+        for setting, value in _settings.items():
+            setattr(self, setting, value)
+
+        # Several faucet accounts can be used to send rewards in parallel
+        self.faucets = [get_faucet_account(key.strip()) for key in self.FAUCET_PRIVKEY.split(',') if key.strip()]
+        self.faucet = self.faucets[0]
+        info(f'Faucet accounts on {_name}: {", ".join([account.address for account in self.faucets])}')
+
+        # Local state is opened before any thread is started for the chain, so a failure
+        # to open it does not leave threads behind when the initialization is repeated
+        if HISTORY_STORAGE == 'sqlite':
+            self.history_storage = SqliteHistoryStorage(f'{JSON_DB_DIR}/{self.SQLITE_HISTORY}')
+            migrate_json_history(f'{JSON_DB_DIR}/{self.JSON_HISTORY}', self.history_storage, self.faucet.address)
+        else:
+            self.history_storage = JsonHistoryStorage(f'{JSON_DB_DIR}/{self.JSON_HISTORY}', self.faucet.address)
+
+        self.journal = SendJournal(f'{JSON_DB_DIR}/{self.SEND_JOURNAL}')
+        self.code_cache = CodeCache(f'{JSON_DB_DIR}/{self.CODE_CACHE}', EOA_CACHE_SIZE)
+        migrate_json_contracts(f'{JSON_DB_DIR}/{self.JSON_CONTRACTS}', self.code_cache)
+
+        self.rpc_pool = PooledProvider(_name, [uri.strip() for uri in self.ZKBOB_RPC.split(',') if uri.strip()])
+        self.w3 = Web3(self.rpc_pool)
+        self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+
+        bob_token = self.w3.eth.contract(abi = ABI, address = self.BOB_TOKEN)
+        event_filter = bob_token.events.Transfer.build_filter()
+        event_filter.indexed_args[0].match_single(self.POOL_CONTRACT)
+        self.token = {
+            'cnt': bob_token,
+            'efilter': event_filter
+        }
+        if self.DISPERSE_CONTRACT:
+            self.DISPERSE_CONTRACT = Web3.toChecksumAddress(self.DISPERSE_CONTRACT)
+            info(f'Rewards on {_name} are batched by {self.DISPERSE_CONTRACT}')
+        # Values of transfers are compared with the threshold in wei
+        self.withdrawal_threshold = Web3.toWei(self.WITHDRAWAL_THRESHOLD, 'ether')
+
+        # The first request starts workers of the pool
+        try:
+            self.chain_id = self.w3.eth.chain_id
+        except Exception:
+            # The workers are stopped, the chain is initialized again from scratch
+            self.rpc_pool.executor.shutdown(wait=False)
+            raise
+
+        # Is reset when the RPC provider does not support FINALITY_TAG until the tag is probed again
+        self.finality_tag_supported = bool(self.FINALITY_TAG)
+        self.finality_tag_probe_at = 0
+        # Blocks scanned in the low-latency mode which are not finalized yet: block number -> hash
+        self.scanned_blocks = OrderedDict()
+
+        self.sending_tested = False
+
+        # Is reset when the RPC provider rejects batched requests for the first time
+        self.rpc_batch_supported = self.RPC_BATCH_SIZE > 1
+        # Is reduced when the RPC provider rejects batches as too large
+        self.rpc_batch_size = self.RPC_BATCH_SIZE
+
+        # Size of sub-ranges of blocks requested by one eth_getLogs call. It is reduced when
+        # the RPC provider complains about too wide range or too many results and grows back after successes
+        self.logs_chunk_size = self.RPC_LIMIT_BLOCK_RANGE
+        self.logs_chunk_successes = 0
+        # Is set while the range of blocks is limited by CATCHUP_BLOCK_RANGE
+        self.catching_up = False
+
+        # Transactions already known as mined: tx hash -> block number. Such transactions
+        # are not requested again, the least recently used hashes are dropped first
+        self.mined_txs = OrderedDict()
+
+        self.fee_oracle = FeeOracle(self)
+        self.tx_watchers = {account.address: PendingTxWatcher(self, account) for account in self.faucets}
+        # Registered last, so a chain failed to initialize does not hold the faucet accounts
+        self.senders = {address: register_faucet_sender(self.chain_id, watcher) 
+                        for address, watcher in self.tx_watchers.items()}
+
+        # The subscription reconnects forever, so it is started when nothing else can fail
+        self.head_subscriber = None
+        if self.ZKBOB_WS_RPC:
+            self.head_subscriber = HeadSubscriber(self.ZKBOB_WS_RPC, 
+                                                  {'address': event_filter.address, 'topics': event_filter.topics},
+                                                  self.FINALIZATION_INTERVAL if self.LOW_LATENCY_INTERVAL < 0 
+                                                  else self.LOW_LATENCY_INTERVAL)
+
+        # Trace of the cycle if it is profiled
+        self.trace = None
+
+# Returns names and settings of all chains watched by the faucet. If CHAINS_CONFIG is not
+# specified the only chain is configured by the environment
+def load_chains_settings():
+    env_settings = {setting: globals()[setting] for setting in CHAIN_SETTINGS}
+    if not CHAINS_CONFIG:
+        check_chain_settings('default', env_settings)
+        return [('default', env_settings)]
+    with open(CHAINS_CONFIG) as f:
+        chains_config = load(f)
+    chains_settings = []
+    for chain_config in chains_config:
+        name = chain_config.get('NAME')
+        if not name:
+            raise BaseException(f'Every chain in {CHAINS_CONFIG} must have a name')
+        settings = dict(env_settings)
+        # Every chain keeps its history in its own files
+        for setting in CHAIN_FILES:
+            settings[setting] = f'{name}-{env_settings[setting]}'
+        for setting, value in chain_config.items():
+            if setting == 'NAME':
+                continue
+            if not setting in CHAIN_SETTINGS:
+                raise BaseException(f'Unknown setting "{setting}" of {name} in {CHAINS_CONFIG}')
+            settings[setting] = CHAIN_SETTINGS[setting](value)
+        check_chain_settings(name, settings)
+        info(f'{name}: ZKBOB_RPC = {settings["ZKBOB_RPC"]}, BOB_TOKEN = {settings["BOB_TOKEN"]}, ' + 
+             f'POOL_CONTRACT = {settings["POOL_CONTRACT"]}, REWARD = {settings["REWARD"]}')
+        chains_settings.append((name, settings))
+    return chains_settings
+
+# Configuration errors stop the faucet before the chains are started: a chain
+# failed in its thread would not be noticed while other chains are running
+def check_chain_settings(_name, _settings):
+    if not _settings['FAUCET_PRIVKEY']:
+        raise BaseException(f"Faucet's privkey is not provided for {_name}. Check the configuration")
+    if _settings['HISTORY_BLOCK_RANGE'] > _settings['RPC_LIMIT_BLOCK_RANGE']:
+        raise BaseException(f"History block range cannot be greater than RPC limit block range for {_name}")
+
+# If a stop files exists, stop the faucet.
+# It will not work if the faucet is run within the docker
+# with the option "restart: unless-stopped"
+def stop_requested():
+    return path.exists(f'{JSON_DB_DIR}/{STOP_FILE}')
+
+# Size of the JSON-RPC request or response in bytes
+def payload_size(_payload):
+    if _payload is None:
+        return 0
+    if isinstance(_payload, requests.Response):
+        return len(_payload.content)
+    return len(dumps(_payload, default=str))
+
+# Structured trace of a profiled cycle: spans of the cycle stages and JSON-RPC requests
+# with their timings and sizes of payloads. Times are relative to the start of the cycle
+class CycleTrace:
+    def __init__(self, _chain_name):
+        self.chain_name = _chain_name
+        self.started_at = time()
+        self.started = monotonic()
+        self.stages = []
+        self.rpc_calls = []
+
+    def stage(self, _name, _started, _duration):
+        self.stages.append({'name': _name, 'start': _started - self.started, 'duration': _duration})
+
+    # Requests can be made by several threads, appending to the list is atomic
+    def rpc(self, _method, _started, _duration, _request, _response):
+        failed = _response is None or (isinstance(_response, dict) and 'error' in _response)
+        self.rpc_calls.append({'method': _method, 'thread': current_thread().name,
+                               'start': _started - self.started, 'duration': _duration,
+                               'request_bytes': payload_size(_request), 'response_bytes': payload_size(_response),
+                               'failed': failed})
+
+    def dump(self, _path):
+        with open(_path, 'w') as f:
+            dump({'chain': self.chain_name,
+                  'started_at': self.started_at,
+                  'duration': monotonic() - self.started,
+                  'stages': self.stages,
+                  'rpc_calls': self.rpc_calls
+                 }, f, indent=1)
+
+# Number of cycles to profile by chains
+profile_requests = {}
+profile_lock = Lock()
+
+def request_profiling(_cycles):
+    with profile_lock:
+        for name in profile_requests:
+            profile_requests[name] = _cycles
+
+# Profiling is requested for all chains by the control file in JSON_DB_DIR. The file
+# contains the number of cycles to profile or is empty to profile PROFILE_CYCLES cycles.
+# The file is removed as soon as the request is accepted
+def check_profile_file():
+    profile_path = f'{JSON_DB_DIR}/{PROFILE_FILE}'
+    if not path.exists(profile_path):
+        return
+    try:
+        with open(profile_path) as f:
+            content = f.read().strip()
+        remove(profile_path)
+    except FileNotFoundError:
+        # The request is accepted by another chain
+        return
+    request_profiling(int(content) if content.isdigit() else PROFILE_CYCLES)
+
+# Profiling is requested for all chains by SIGUSR1. The handler is called in the main
+# thread which does not log anything, so logging is left to the chains
+def on_profile_signal(_signum, _frame):
+    request_profiling(PROFILE_CYCLES)
+
+# Measures the duration of the stage of the cycle, the stage is added to the trace if the cycle is profiled
+@contextmanager
+def measure_stage(_chain, _stage):
+    started = monotonic()
+    try:
+        yield
+    finally:
+        duration = monotonic() - started
+        stage_duration.labels(_chain.name, _stage).observe(duration)
+        if _chain.trace is not None:
+            _chain.trace.stage(_stage, started, duration)
+
+# Profiles the cycle if profiling of the chain is requested. cProfile stats of the chain thread
+# and the trace of the cycle are written to JSON_DB_DIR. Nothing is measured otherwise
+@contextmanager
+def profile_cycle(_chain):
+    with profile_lock:
+        cycles = profile_requests.get(_chain.name, 0)
+        if cycles > 0:
+            profile_requests[_chain.name] = cycles - 1
+    if cycles == 0:
+        yield
+        return
+    info(f'Profiling the cycle, {cycles - 1} more cycles will be profiled')
+    trace = CycleTrace(_chain.name)
+    profiler = cProfile.Profile()
+    _chain.trace = trace
+    _chain.rpc_pool.trace = trace
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _chain.trace = None
+        _chain.rpc_pool.trace = None
+        started_at = strftime("%Y%m%d-%H%M%S", localtime(trace.started_at)) + f'.{int(trace.started_at * 1000) % 1000:03d}'
+        prefix = f'{JSON_DB_DIR}/{_chain.name}-cycle-{started_at}'
+        profiler.dump_stats(f'{prefix}.prof')
+        trace.dump(f'{prefix}.trace.json')
+        info(f'Profile of the cycle is written to {prefix}.prof and {prefix}.trace.json')
+
+# Reward transactions journaled but not committed before the restart are broadcasted
+# again, so there are no gaps in nonces, and are recorded as reward attempts
+def replay_send_journal(_chain, _last_block, _handled_index, _nonces):
+    entries = _chain.journal.read()
+    if len(entries) == 0:
+        return
+    info(f'Replaying {len(entries)} reward transactions from {_chain.journal.path}')
+    for entry in entries:
+        # The transaction is broadcasted again by the watcher if it is not accepted now
+        raw = HexBytes(entry['raw'])
+        try:
+            sent_raw_transaction(_chain, raw, HexBytes(entry['hash']), entry['recipients'])
+            raw = None
+        except Exception as e:
+            error(f'Reward to {", ".join(entry["recipients"])} with nonce {entry["nonce"]} was not sent again: {e}')
+        # The transaction could be broadcasted before the crash anyway
+        attempt = {recipient: entry['hash'] for recipient in entry['recipients']}
+        _handled_index.add(entry['block'], attempt)
+        _chain.history_storage.add_attempts(entry['block'], attempt)
+        _nonces.setdefault(entry['sender'], {})[str(entry['nonce'])] = entry['gas_price']
+        _chain.history_storage.store_nonce(entry['sender'], entry['nonce'], entry['gas_price'])
+        if entry['sender'] in _chain.tx_watchers:
+            _chain.tx_watchers[entry['sender']].track(entry['nonce'], entry['recipients'], entry['hash'], 
+                                                      entry['gas_price'], raw)
+    _chain.history_storage.commit(_last_block)
+    _chain.journal.clear()
+
+# Discovers recipients on the chain and rewards them.
+# Returns the last block monitored by the cycle
+def run_cycle(_chain, _previous_last_block, _handled_index, _nonces):
+    head_block, finalized_block, fork_block = get_chain_tip(_chain)
+    if fork_block is not None:
+        undo_orphaned_blocks(_chain, fork_block, _handled_index)
+        _previous_last_block = min(_previous_last_block, fork_block)
+    head = int(head_block['number'], 16)
+    observation_range = get_observation_range(_chain, _previous_last_block, head, finalized_block)
+    if _chain.LOW_LATENCY_INTERVAL >= 0:
+        remember_scanned_block(_chain, observation_range[1], head_block, finalized_block)
+    # While the faucet catches up after downtime, rewards are checked and recorded by the tip
+    # rather than by the end of the limited range: balances are requested from recent blocks
+    # and attempts of previous catch-up cycles are not revisited before they could be mined
+    reward_range = (observation_range[0], observation_range[2])
+
+    with measure_stage(_chain, 'get_recipients'):
+        recipients = get_recipients(_chain, observation_range[0], observation_range[1])
+
+    with measure_stage(_chain, 'revisit_previous_rewards'):
+        recipients.update(revisit_previous_rewards(_chain, _handled_index, reward_range))
+
+    with measure_stage(_chain, 'soap_recipients'):
+        endowing = soap_recipients(_chain, recipients, _handled_index, reward_range)
+
+    # Balances are requested every cycle to keep their metrics up to date
+    with measure_stage(_chain, 'get_faucet_balances'):
+        balances = get_faucet_balances(_chain)
 
     balance_error = False
     if len(endowing) > 0:
-        # Get the current balance of the faucet to avoid attempts
-        # to send rewards when the faucet has no funds
-        faucet_balance = make_web3_call(plg_w3.eth.getBalance, faucet.address)
-        info(f'faucet balance: {faucet_balance}')
-
-        max_gas_price, recommended_priority_fee = estimate_gas_price()
-
-        # Check if the faucet has enough funds to send all discovered rewards
-        if faucet_balance > len(endowing) * GAS_LIMIT * max_gas_price:
-            update_for_handled_recipients = {}
-
-            nonce = make_web3_call(plg_w3.eth.getTransactionCount, faucet.address)
-            # Since a new nonce received remove old records from the gas prices history log
-            for existing_nonce in list(nonces):
-                if int(existing_nonce) < nonce:
-                    del nonces[existing_nonce]
-            info(f'starting nonce: {nonce}')
-
-            for recipient in endowing:
-                # if exists a record in the gas price history log it means that the faucet
-                # already tried to send a transaction with the same nonce
-                # in order to avoid getting 'replacement transaction underpriced' RPC error
-                # it is necessary to adjust the estimated gas price
-                tx_max_gas_price = max_gas_price
-                tx_recommended_priority_fee = recommended_priority_fee
-                str_nonce = str(nonce)
-                if str_nonce in nonces:
-                    tx_max_gas_price, tx_recommended_priority_fee = adjust_gas_price([max_gas_price, recommended_priority_fee], 
-                                                                                    nonces[str_nonce])
-                    
-                tx = {
-                    'nonce': nonce,
-                    'gas': GAS_LIMIT,
-                    'data': b'Rewarded for zkBOB withdrawal',
-                    'chainId': plg_chainId,
-                    'value': Web3.toWei(REWARD, 'ether'),
-                    'to': recipient,
-                }
-                if GAS_PRICE < 0:
-                    tx['maxFeePerGas'] = tx_max_gas_price
-                    tx['maxPriorityFeePerGas'] = tx_recommended_priority_fee
-                else:
-                    tx['gasPrice'] = tx_max_gas_price
-                    
-                rawtx = faucet.signTransaction(tx)
-                sent_tx_hash = sent_raw_transaction(rawtx)
-                # Record the attempt to send the reward
-                update_for_handled_recipients[recipient] = sent_tx_hash
-                # Store values for gas price used in the transaction with current nonce
-                nonces[str_nonce] = [tx_max_gas_price, tx_recommended_priority_fee]
-                
-                nonce += 1
-                sleep(0.1)
-            # Store all reward attempts made after events observation limited by the lates block
-            handled_recipients[str(observation_range[1])] = update_for_handled_recipients
-        else:
-            error(f'not enough balance on the faucet {faucet.address}')
-            balance_error = True
+        with measure_stage(_chain, 'estimate_gas_price'):
+            gas_price = list(estimate_gas_price(_chain, head))
+
+        # Every faucet account sends rewards to its own share of recipients
+        # with its own sequence of nonces
+        shards = assign_to_faucets(_chain, endowing)
+        with measure_stage(_chain, 'send_rewards'), \
+             ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix=_chain.name) as executor:
+            results = list(executor.map(lambda shard: reward_by_faucet(_chain, shard[0], shard[1], gas_price, 
+                                                                       _nonces[shard[0].address],
+                                                                       reward_range[1], balances[shard[0].address]),
+                                        shards))
+
+        update_for_handled_recipients = {}
+        for (account, _), result in zip(shards, results):
+            if result is None:
+                balance_error = True
+            else:
+                record_sent_rewards(_chain, account, *result, update_for_handled_recipients)
+        # Store all reward attempts made after events observation limited by the lates block
+        _handled_index.add(reward_range[1], update_for_handled_recipients)
+        _chain.history_storage.add_attempts(reward_range[1], update_for_handled_recipients)
 
+    # The next part of missed blocks is scanned without waiting
+    _chain.catching_up = not balance_error and observation_range[1] < observation_range[2]
     if not balance_error:
-        save_storage_of_handled(observation_range, handled_recipients, nonces)
-            
-    sleep(POLLING_INTERVAL)
\ No newline at end of file
+        save_storage_of_handled(_chain, observation_range, _handled_index)
+        return observation_range[1]
+    # Recipients of the faucet accounts without funds will be discovered again
+    # but the rewards sent by other accounts must be kept
+    _chain.history_storage.commit(_previous_last_block)
+    _chain.journal.clear()
+    return _previous_last_block
+
+# Runs cycles on the chain until the faucet is stopped. A failure on one chain
+# does not affect other chains: the cycle is restarted from the stored data
+# after POLLING_INTERVAL seconds
+def run_chain(_name, _settings):
+    current_thread().name = _name
+    with profile_lock:
+        profile_requests[_name] = 0
+    chain = None
+    previous_last_block = None
+    while not stop_requested():
+        try:
+            if chain is None:
+                chain = Chain(_name, _settings)
+            if previous_last_block is None:
+                previous_last_block, handled_index, nonces = get_storage_of_handled(chain)
+                replay_send_journal(chain, previous_last_block, handled_index, nonces)
+            check_profile_file()
+            with profile_cycle(chain), measure_stage(chain, 'cycle'):
+                previous_last_block = run_cycle(chain, previous_last_block, handled_index, nonces)
+            if not chain.catching_up:
+                wait_for_next_cycle(chain, previous_last_block, handled_index, nonces)
+            elif count_pending_txs(chain) > 0:
+                # Cycles catching up follow each other without waiting, so stuck and unsent
+                # transactions are handled between them
+                check_pending_txs(chain, get_head_block(chain), previous_last_block, handled_index, nonces)
+        except Exception as e:
+            error(f'Cycle failed, restarting in {POLLING_INTERVAL} seconds: {e}')
+            if chain is not None:
+                chain.history_storage.rollback()
+            previous_last_block = None
+            sleep(POLLING_INTERVAL)
+    info("Stopping faucet")
+
+# Pipelines of all chains run concurrently in one process sharing the RPC
+# connections. web3 calls are blocking so every
+# chain is driven by its own thread of the engine
+async def run_chains(_chains_settings):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=len(_chains_settings)) as executor:
+        await asyncio.gather(*[loop.run_in_executor(executor, run_chain, name, settings) 
+                               for name, settings in _chains_settings])
+
+# The engine is not started if the script is imported, e.g. by tests
+if __name__ == '__main__':
+    chains_settings = load_chains_settings()
+    signal(SIGUSR1, on_profile_signal)
+    if METRICS_PORT > 0:
+        start_http_server(METRICS_PORT)
+        info(f'Metrics are available on port {METRICS_PORT}')
+    if len(chains_settings) > 1:
+        # Messages of different chains are distinguished by names of their threads
+        basicConfig(level=INFO, format='%(levelname)s:%(threadName)s:%(message)s', force=True)
+    asyncio.run(run_chains(chains_settings))
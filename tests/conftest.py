@@ -0,0 +1,22 @@
+from importlib.util import spec_from_file_location, module_from_spec
+from os import environ, path
+import sys
+
+import pytest
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+FAUCET_SCRIPT = path.join(ROOT, 'bridge-faucet.py')
+# Mock nodes of the benchmark are reused by the tests
+sys.path.append(path.join(ROOT, 'bench'))
+# Well known test key, nothing is sent by the tests
+FAUCET_PRIVKEY = '4c0883a69102937d6231471b5dbb6204fe5129617082792ae468d01a3f362318'
+
+# The faucet is a script with a dash in the name, so it is loaded from the file.
+# The configuration is read on import, the engine is not started
+@pytest.fixture(scope='session')
+def faucet():
+    environ.setdefault('FAUCET_PRIVKEY', FAUCET_PRIVKEY)
+    spec = spec_from_file_location('bridge_faucet', FAUCET_SCRIPT)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+from eth_abi import decode_abi
+from web3 import Web3
+
+DISPERSE_CONTRACT = '0xD152f549545093347A162Dce210e7293f1452150'
+RECIPIENTS = [Web3.toChecksumAddress(f'0x{i:040x}') for i in range(1, 6)]
+GAS_PRICE = (50 * 10**9, 2 * 10**9)
+
+def make_chain(**_settings):
+    settings = dict(REWARD=0.1, chain_id=137, GAS_PRICE=-1, GAS_LIMIT=30000, DISPERSE_CONTRACT=DISPERSE_CONTRACT,
+                    DISPERSE_GAS_PER_RECIPIENT=10000, DISPERSE_GAS_LIMIT=100000)
+    settings.update(_settings)
+    return SimpleNamespace(**settings)
+
+def test_disperse_selector(faucet):
+    assert faucet.DISPERSE_ETHER_SELECTOR == bytes.fromhex('e63d38ed')
+
+def test_single_recipient_is_rewarded_directly(faucet):
+    tx = faucet.build_reward_tx(make_chain(), RECIPIENTS[:1], 7, GAS_PRICE)
+    assert tx['to'] == RECIPIENTS[0]
+    assert tx['value'] == Web3.toWei(0.1, 'ether')
+    assert tx['data'] == b'Rewarded for zkBOB withdrawal'
+    assert tx['gas'] == 30000
+    assert tx['nonce'] == 7
+    assert tx['chainId'] == 137
+
+def test_batch_is_rewarded_by_disperse_contract(faucet):
+    tx = faucet.build_reward_tx(make_chain(), RECIPIENTS, 3, GAS_PRICE)
+    reward = Web3.toWei(0.1, 'ether')
+    assert tx['to'] == DISPERSE_CONTRACT
+    assert tx['value'] == reward * len(RECIPIENTS)
+    assert tx['data'][:4] == bytes.fromhex('e63d38ed')
+    recipients, values = decode_abi(['address[]', 'uint256[]'], tx['data'][4:])
+    assert [Web3.toChecksumAddress(recipient) for recipient in recipients] == RECIPIENTS
+    assert list(values) == [reward] * len(RECIPIENTS)
+    assert tx['gas'] == 30000 + len(RECIPIENTS) * 10000
+
+def test_gas_price_fields(faucet):
+    tx = faucet.build_reward_tx(make_chain(), RECIPIENTS, 0, GAS_PRICE)
+    assert (tx['maxFeePerGas'], tx['maxPriorityFeePerGas']) == GAS_PRICE
+    assert 'gasPrice' not in tx
+    tx = faucet.build_reward_tx(make_chain(GAS_PRICE=50), RECIPIENTS, 0, GAS_PRICE)
+    assert tx['gasPrice'] == GAS_PRICE[0]
+    assert 'maxFeePerGas' not in tx
+
+def test_split_without_disperse_contract(faucet):
+    assert faucet.split_to_batches(make_chain(DISPERSE_CONTRACT=''), RECIPIENTS) == [[recipient] for recipient in RECIPIENTS]
+
+def test_split_by_disperse_gas_limit(faucet):
+    # (100000 - 30000) // 10000 = 7 recipients per batch
+    recipients = [Web3.toChecksumAddress(f'0x{i:040x}') for i in range(1, 17)]
+    batches = faucet.split_to_batches(make_chain(), recipients)
+    assert [len(batch) for batch in batches] == [7, 7, 2]
+    assert sum(batches, []) == recipients
+    assert all(faucet.reward_gas_limit(make_chain(), batch) <= 100000 for batch in batches)
+
+def test_split_keeps_one_recipient_if_gas_limit_is_too_low(faucet):
+    batches = faucet.split_to_batches(make_chain(DISPERSE_GAS_LIMIT=35000), RECIPIENTS)
+    assert batches == [[recipient] for recipient in RECIPIENTS]
+
+def test_reward_gas_limit(faucet):
+    assert faucet.reward_gas_limit(make_chain(), RECIPIENTS[:1]) == 30000
+    assert faucet.reward_gas_limit(make_chain(), RECIPIENTS[:2]) == 50000
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+HEAD = {'number': hex(1000), 'hash': '0x' + '11' * 32}
+FINALIZED = {'number': hex(936), 'hash': '0x' + '22' * 32}
+UNSUPPORTED = ValueError({'code': -32602, 'message': 'invalid argument 0: hex string without 0x prefix'})
+HEADER_NOT_FOUND = ValueError({'code': -32000, 'message': 'header not found'})
+
+@pytest.fixture
+def chain():
+    return SimpleNamespace(FINALITY_TAG='finalized', FINALIZATION_INTERVAL=128, finality_tag_supported=True,
+                           finality_tag_probe_at=0, scanned_blocks=OrderedDict())
+
+@pytest.fixture
+def responses(faucet, monkeypatch):
+    # Responses to the batches of get_chain_tip: head and the block by the tag if it is requested
+    responses = []
+    monkeypatch.setattr(faucet, 'make_web3_batch_call', lambda _chain, _calls: [HEAD] + responses[:len(_calls) - 1])
+    return responses
+
+def test_unsupported_tag_errors(faucet):
+    assert faucet.is_unsupported_tag_error(UNSUPPORTED)
+    assert faucet.is_unsupported_tag_error(ValueError({'code': -39001, 'message': 'finalized block not found'}))
+    assert faucet.is_unsupported_tag_error(ValueError({'code': -32000, 'message': 'unsupported block tag'}))
+    assert not faucet.is_unsupported_tag_error(HEADER_NOT_FOUND)
+    assert not faucet.is_unsupported_tag_error(ValueError({'code': -32000, 'message': 'unknown block'}))
+    assert not faucet.is_unsupported_tag_error(ValueError({'code': -32005, 'message': 'rate limit exceeded'}))
+
+def test_finalized_block_by_tag(faucet, chain, responses):
+    responses.append(FINALIZED)
+    assert faucet.get_chain_tip(chain) == (HEAD, 936, None)
+
+def test_transient_errors_keep_the_tag(faucet, chain, responses):
+    responses.append(HEADER_NOT_FOUND)
+    with pytest.raises(ValueError):
+        faucet.get_chain_tip(chain)
+    assert chain.finality_tag_supported
+
+def test_unsupported_tag_is_probed_again(faucet, chain, responses, monkeypatch):
+    responses.append(UNSUPPORTED)
+    assert faucet.get_chain_tip(chain) == (HEAD, 1000 - 128, None)
+    assert not chain.finality_tag_supported
+    responses[0] = FINALIZED
+    # The tag is not requested until the probe interval expires
+    assert faucet.get_chain_tip(chain)[1] == 1000 - 128
+    monkeypatch.setattr(faucet, 'monotonic', lambda: chain.finality_tag_probe_at)
+    assert faucet.get_chain_tip(chain)[1] == 936
+    assert chain.finality_tag_supported
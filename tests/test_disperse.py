@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+from eth_account import Account
+from web3 import Web3
+
+pytest.importorskip('eth_tester')
+from web3 import EthereumTesterProvider
+
+# Minimal disperse contract: disperseEther(address[] recipients, uint256[] values) sends
+# values[i] to recipients[i] and reverts if any transfer fails or the selector is unknown.
+# It is assembled here since a Solidity compiler is not available to the tests
+DISPERSE_RUNTIME = [
+    'PUSH1 0x00', 'CALLDATALOAD', 'PUSH1 0xe0', 'SHR', 'PUSH4 0xe63d38ed', 'EQ', 'PUSH1 @start', 'JUMPI',
+    '@fail', 'PUSH1 0x00', 'DUP1', 'REVERT',
+    # Stack: recipients offset, values offset, number of recipients, index
+    '@start', 'PUSH1 0x04', 'CALLDATALOAD', 'PUSH1 0x04', 'ADD',
+    'PUSH1 0x24', 'CALLDATALOAD', 'PUSH1 0x04', 'ADD',
+    'DUP2', 'CALLDATALOAD', 'PUSH1 0x00',
+    '@loop', 'DUP2', 'DUP2', 'LT', 'ISZERO', 'PUSH1 @end', 'JUMPI',
+    # call(gas, recipient, value, 0, 0, 0, 0)
+    'PUSH1 0x00', 'DUP1', 'DUP1', 'DUP1',
+    'DUP5', 'PUSH1 0x01', 'ADD', 'PUSH1 0x20', 'MUL', 'DUP8', 'ADD', 'CALLDATALOAD',
+    'DUP6', 'PUSH1 0x01', 'ADD', 'PUSH1 0x20', 'MUL', 'DUP10', 'ADD', 'CALLDATALOAD',
+    'GAS', 'CALL', 'ISZERO', 'PUSH1 @fail', 'JUMPI',
+    'PUSH1 0x01', 'ADD', 'PUSH1 @loop', 'JUMP',
+    '@end', 'STOP',
+]
+OPCODES = {'STOP': 0x00, 'ADD': 0x01, 'MUL': 0x02, 'LT': 0x10, 'EQ': 0x14, 'ISZERO': 0x15, 'SHR': 0x1c,
+           'CALLDATALOAD': 0x35, 'CODECOPY': 0x39, 'JUMP': 0x56, 'JUMPI': 0x57, 'GAS': 0x5a, 'JUMPDEST': 0x5b,
+           'PUSH1': 0x60, 'PUSH4': 0x63, 'DUP1': 0x80, 'DUP2': 0x81, 'DUP5': 0x84, 'DUP6': 0x85, 'DUP8': 0x87,
+           'DUP10': 0x89, 'CALL': 0xf1, 'RETURN': 0xf3, 'REVERT': 0xfd}
+
+def assemble(_code):
+    # Labels are jump destinations, every instruction is one byte plus its argument
+    labels = {}
+    size = 0
+    for instruction in _code:
+        if instruction.startswith('@'):
+            labels[instruction] = size
+            size += 1
+        else:
+            name = instruction.split()[0]
+            size += 1 + (int(name[4:]) if name.startswith('PUSH') else 0)
+    code = b''
+    for instruction in _code:
+        if instruction.startswith('@'):
+            code += bytes([OPCODES['JUMPDEST']])
+            continue
+        name, *argument = instruction.split()
+        code += bytes([OPCODES[name]])
+        if argument:
+            value = labels[argument[0]] if argument[0].startswith('@') else int(argument[0], 16)
+            code += value.to_bytes(int(name[4:]), 'big')
+    return code
+
+def deploy_code(_runtime):
+    # Copies the runtime code placed after the 11 bytes of the deployment code and returns it
+    runtime = assemble(_runtime)
+    return assemble([f'PUSH1 {len(runtime):#x}', 'DUP1', 'PUSH1 0x0b', 'PUSH1 0x00', 'CODECOPY',
+                     'PUSH1 0x00', 'RETURN']) + runtime
+
+@pytest.fixture
+def w3():
+    return Web3(EthereumTesterProvider())
+
+@pytest.fixture
+def sender(w3):
+    # The first account of eth-tester
+    return Account.from_key('0x' + '00' * 31 + '01')
+
+def send(_w3, _account, _tx):
+    tx_hash = _w3.eth.send_raw_transaction(_account.sign_transaction(_tx).rawTransaction)
+    return _w3.eth.wait_for_transaction_receipt(tx_hash)
+
+def test_batch_rewards_recipients_through_disperse_contract(faucet, w3, sender):
+    gas_price = (10 * 10**9, 10**9)
+    receipt = send(w3, sender, {'nonce': 0, 'gas': 200000, 'data': deploy_code(DISPERSE_RUNTIME), 'value': 0,
+                                'chainId': w3.eth.chain_id, 'maxFeePerGas': gas_price[0],
+                                'maxPriorityFeePerGas': gas_price[1]})
+    # Gas is reserved by the defaults for transfers to new accounts
+    chain = SimpleNamespace(REWARD=0.1, chain_id=w3.eth.chain_id, GAS_PRICE=-1, GAS_LIMIT=faucet.GAS_LIMIT,
+                            DISPERSE_CONTRACT=receipt['contractAddress'],
+                            DISPERSE_GAS_PER_RECIPIENT=faucet.DISPERSE_GAS_PER_RECIPIENT,
+                            DISPERSE_GAS_LIMIT=faucet.DISPERSE_GAS_LIMIT)
+    recipients = [Web3.toChecksumAddress(f'0x{i:040x}') for i in range(0x1001, 0x1006)]
+    batches = faucet.split_to_batches(chain, recipients)
+    assert [len(batch) for batch in batches] == [5]
+
+    receipt = send(w3, sender, faucet.build_reward_tx(chain, batches[0], 1, gas_price))
+    assert receipt['status'] == 1
+    assert receipt['gasUsed'] <= faucet.reward_gas_limit(chain, batches[0])
+    for recipient in recipients:
+        assert w3.eth.get_balance(recipient) == Web3.toWei(0.1, 'ether')
+    assert w3.eth.get_balance(chain.DISPERSE_CONTRACT) == 0
+
+def test_disperse_contract_rejects_unknown_selector(w3, sender):
+    gas_price = (10 * 10**9, 10**9)
+    receipt = send(w3, sender, {'nonce': 0, 'gas': 200000, 'data': deploy_code(DISPERSE_RUNTIME), 'value': 0,
+                                'chainId': w3.eth.chain_id, 'maxFeePerGas': gas_price[0],
+                                'maxPriorityFeePerGas': gas_price[1]})
+    receipt = send(w3, sender, {'nonce': 1, 'gas': 100000, 'to': receipt['contractAddress'], 'data': b'\x00' * 4,
+                                'value': 0, 'chainId': w3.eth.chain_id, 'maxFeePerGas': gas_price[0],
+                                'maxPriorityFeePerGas': gas_price[1]})
+    assert receipt['status'] == 0
@@ -0,0 +1,116 @@
+from threading import Timer
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+import pytest
+
+from mock_ws_node import MockWsNode
+
+def wait_until(_condition, _timeout=5):
+    deadline = monotonic() + _timeout
+    while not _condition():
+        assert monotonic() < deadline, 'condition is not met in time'
+        sleep(0.05)
+
+@pytest.fixture
+def make_subscriber(faucet, monkeypatch):
+    # Subscribers are reconnected in a second after the connection is dropped
+    monkeypatch.setattr(faucet, 'WEB3_RETRY_DELAY', 0)
+    nodes = []
+
+    def make(_logs=True, _finality_lag=10):
+        node = MockWsNode(_logs)
+        nodes.append(node)
+        subscriber = faucet.HeadSubscriber(f'ws://127.0.0.1:{node.serve(0)}', {}, _finality_lag)
+        wait_until(lambda: subscriber.connected and subscriber.logs_subscribed == _logs)
+        return node, subscriber
+
+    yield make
+    for node in nodes:
+        node.stop()
+
+def test_new_heads(make_subscriber):
+    node, subscriber = make_subscriber()
+    node.push_head(100)
+    assert subscriber.wait_for_head(None, 5) == 100
+    assert subscriber.wait_for_head(100, 0.2) is None
+    node.push_head(101)
+    assert subscriber.wait_for_head(100, 5) == 101
+
+def test_scan_needed_by_finalized_transfers(make_subscriber):
+    node, subscriber = make_subscriber()
+    node.push_log(95)
+    node.push_head(100)
+    subscriber.wait_for_head(None, 5)
+    # The transfer is not finalized yet
+    assert not subscriber.scan_needed(80)
+    node.push_head(105)
+    subscriber.wait_for_head(100, 5)
+    assert subscriber.scan_needed(80)
+    # The transfer is already scanned
+    assert not subscriber.scan_needed(95)
+
+def test_removed_transfers_are_forgotten(make_subscriber):
+    node, subscriber = make_subscriber()
+    node.push_log(95)
+    node.push_log(95, True)
+    node.push_head(110)
+    subscriber.wait_for_head(None, 5)
+    assert not subscriber.scan_needed(80)
+
+def test_scan_needed_by_finality_lag_without_logs(make_subscriber):
+    node, subscriber = make_subscriber(_logs=False)
+    node.push_head(100)
+    subscriber.wait_for_head(None, 5)
+    assert subscriber.scan_needed(85)
+    assert not subscriber.scan_needed(90)
+    # The finalized block reported by the provider lags further than the default
+    subscriber.set_finality_lag(64)
+    assert not subscriber.scan_needed(85)
+
+def test_dropped_subscription_is_restored(make_subscriber):
+    node, subscriber = make_subscriber()
+    node.push_head(100)
+    subscriber.wait_for_head(None, 5)
+    node.drop()
+    wait_until(lambda: not subscriber.connected)
+    assert subscriber.wait_for_head(100, 0.2) is None
+    assert not subscriber.scan_needed(0)
+    wait_until(lambda: subscriber.connected and subscriber.logs_subscribed)
+
+def make_chain(_subscriber):
+    return SimpleNamespace(head_subscriber=_subscriber, tx_watchers={})
+
+def measure_wait(_faucet, _chain, _last_block):
+    started = monotonic()
+    _faucet.wait_for_next_cycle(_chain, _last_block, None, {})
+    return monotonic() - started
+
+def test_cycle_waits_for_new_finalized_blocks(faucet, make_subscriber, monkeypatch):
+    monkeypatch.setattr(faucet, 'POLLING_INTERVAL', 1)
+    node, subscriber = make_subscriber(_logs=False)
+    node.push_head(100)
+    subscriber.wait_for_head(None, 5)
+    # The known head does not finalize blocks after the last scanned one
+    assert measure_wait(faucet, make_chain(subscriber), 90) >= 0.9
+
+def test_cycle_starts_on_finalized_transfer(faucet, make_subscriber, monkeypatch):
+    monkeypatch.setattr(faucet, 'POLLING_INTERVAL', 10)
+    node, subscriber = make_subscriber()
+    node.push_head(100)
+    subscriber.wait_for_head(None, 5)
+
+    def push():
+        node.push_log(95)
+        node.push_head(105)
+
+    Timer(0.3, push).start()
+    assert measure_wait(faucet, make_chain(subscriber), 90) < 5
+
+def test_cycle_falls_back_to_polling(faucet, make_subscriber, monkeypatch):
+    monkeypatch.setattr(faucet, 'POLLING_INTERVAL', 1)
+    monkeypatch.setattr(faucet, 'STUCK_TX_CHECK_INTERVAL', 0.2)
+    node, subscriber = make_subscriber()
+    node.stop()
+    wait_until(lambda: not subscriber.connected)
+    assert 0.9 <= measure_wait(faucet, make_chain(subscriber), 90) < 5
@@ -0,0 +1,69 @@
+from json import dump
+from os import path
+
+import pytest
+
+SENDER = '0x2c7536E3605D9C16a7a3D7b1898e529396a65c23'
+OTHER_SENDER = '0x' + '33' * 20
+ACCOUNT = '0x' + '11' * 20
+OTHER_ACCOUNT = '0x' + '22' * 20
+
+@pytest.fixture(params=['sqlite', 'json'])
+def storage(faucet, tmp_path, request):
+    if request.param == 'sqlite':
+        return faucet.SqliteHistoryStorage(str(tmp_path / 'history.sqlite'))
+    return faucet.JsonHistoryStorage(str(tmp_path / 'history.json'), SENDER)
+
+def test_rewind_history(storage):
+    storage.add_attempts(10, {ACCOUNT: '0x10'})
+    storage.add_attempts(20, {OTHER_ACCOUNT: '0x20'})
+    storage.add_attempts(30, {ACCOUNT: '0x30'})
+    storage.rewind_history(15)
+    # Attempts made in orphaned blocks are kept in the fork block, the latest attempt wins
+    assert storage.get_history(0) == {'10': {ACCOUNT: '0x10'}, '15': {OTHER_ACCOUNT: '0x20', ACCOUNT: '0x30'}}
+    storage.rewind_history(15)
+    assert storage.get_history(0) == {'10': {ACCOUNT: '0x10'}, '15': {OTHER_ACCOUNT: '0x20', ACCOUNT: '0x30'}}
+
+def test_rollback(storage):
+    storage.add_attempts(10, {ACCOUNT: '0x10'})
+    storage.commit(10)
+    storage.add_attempts(20, {OTHER_ACCOUNT: '0x20'})
+    storage.store_nonce(SENDER, 1, [2, 1])
+    storage.rollback()
+    assert storage.get_history(0) == {'10': {ACCOUNT: '0x10'}}
+    assert storage.get_nonces() == {}
+
+def write_json_history(_path, _nonces):
+    with open(_path, 'w') as f:
+        dump({'last_block': 500, 'history': {'400': {ACCOUNT: '0x40'}, '450': {OTHER_ACCOUNT: '0x45'}},
+              'nonces': _nonces}, f)
+
+def test_migrate_json_history(faucet, tmp_path):
+    json_path = str(tmp_path / 'history.json')
+    write_json_history(json_path, {SENDER: {'7': [20, 2]}, OTHER_SENDER: {'3': [10, 1]}})
+    storage = faucet.SqliteHistoryStorage(str(tmp_path / 'history.sqlite'))
+    faucet.migrate_json_history(json_path, storage, SENDER)
+    assert storage.get_last_block() == 500
+    assert storage.get_history(0) == {'400': {ACCOUNT: '0x40'}, '450': {OTHER_ACCOUNT: '0x45'}}
+    assert storage.get_nonces() == {SENDER: {'7': [20, 2]}, OTHER_SENDER: {'3': [10, 1]}}
+    assert not path.exists(json_path)
+    assert path.exists(f'{json_path}.migrated')
+
+def test_migrate_json_history_without_senders(faucet, tmp_path):
+    # Files stored before several faucet accounts were supported keep nonces of the first account
+    json_path = str(tmp_path / 'history.json')
+    write_json_history(json_path, {'7': [20, 2]})
+    storage = faucet.SqliteHistoryStorage(str(tmp_path / 'history.sqlite'))
+    faucet.migrate_json_history(json_path, storage, SENDER)
+    assert storage.get_nonces() == {SENDER: {'7': [20, 2]}}
+
+def test_migration_does_not_overwrite_history(faucet, tmp_path):
+    json_path = str(tmp_path / 'history.json')
+    write_json_history(json_path, {})
+    storage = faucet.SqliteHistoryStorage(str(tmp_path / 'history.sqlite'))
+    storage.add_attempts(600, {ACCOUNT: '0x60'})
+    storage.commit(600)
+    faucet.migrate_json_history(json_path, storage, SENDER)
+    assert storage.get_last_block() == 600
+    assert storage.get_history(0) == {'600': {ACCOUNT: '0x60'}}
+    assert path.exists(json_path)
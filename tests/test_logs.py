@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+TOO_WIDE = {'code': -32005, 'message': 'query returned more than 10000 results'}
+HEADER_NOT_FOUND = {'code': -32000, 'message': 'header not found'}
+
+@pytest.fixture
+def chain():
+    return SimpleNamespace(token={'efilter': SimpleNamespace(address='0x' + '00' * 20, topics=[])},
+                           RPC_LIMIT_BLOCK_RANGE=99, logs_chunk_size=99, logs_chunk_successes=0)
+
+@pytest.fixture
+def rpc(faucet, monkeypatch):
+    # Errors are returned for the first requests, then every block of the range has a log
+    errors = []
+    ranges = []
+
+    def make_rpc_request(_chain, _method, _params):
+        ranges.append((int(_params[0]['fromBlock'], 16), int(_params[0]['toBlock'], 16)))
+        if len(errors) > 0:
+            raise ValueError(errors.pop(0))
+        return list(range(ranges[-1][0], ranges[-1][1] + 1))
+
+    monkeypatch.setattr(faucet, 'WEB3_RETRY_DELAY', 0)
+    monkeypatch.setattr(faucet, 'make_rpc_request', make_rpc_request)
+    return SimpleNamespace(errors=errors, ranges=ranges)
+
+def test_refused_range_is_split(faucet, chain, rpc):
+    rpc.errors.append(TOO_WIDE)
+    assert faucet.get_logs_adaptively(chain, 0, 99) == list(range(100))
+    assert rpc.ranges == [(0, 99), (0, 49), (50, 99)]
+    assert chain.logs_chunk_size == 49
+
+def test_transient_error_is_repeated(faucet, chain, rpc):
+    rpc.errors.append(HEADER_NOT_FOUND)
+    assert faucet.get_logs_adaptively(chain, 0, 99) == list(range(100))
+    # The range is not split by the error unrelated to it
+    assert rpc.ranges == [(0, 99), (0, 99)]
+    assert chain.logs_chunk_size == 99
+
+def test_persistent_error_fails(faucet, chain, rpc, monkeypatch):
+    monkeypatch.setattr(faucet, 'WEB3_RETRY_ATTEMPTS', 2)
+    rpc.errors.extend([HEADER_NOT_FOUND] * 3)
+    with pytest.raises(ValueError):
+        faucet.get_logs_adaptively(chain, 0, 99)
+    assert len(rpc.ranges) == 3
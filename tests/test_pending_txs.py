@@ -0,0 +1,171 @@
+from types import SimpleNamespace
+
+import pytest
+from eth_account import Account
+from web3 import Web3
+
+FAUCET_PRIVKEY = '4c0883a69102937d6231471b5dbb6204fe5129617082792ae468d01a3f362318'
+RECIPIENT = Web3.toChecksumAddress(f'0x{0x1001:040x}')
+GWEI = 10**9
+
+INTERNAL_ERROR = {'code': -32603, 'message': 'internal error'}
+
+# Node accepting all transactions, the next transactions are rejected by the errors if they are set
+class MockEth:
+    def __init__(self):
+        self.mined_nonce = 0
+        self.sent = []
+        self.errors = []
+
+    def getTransactionCount(self, _address, _block):
+        return self.mined_nonce
+
+    def sendRawTransaction(self, _raw):
+        if len(self.errors) > 0:
+            raise ValueError(self.errors.pop(0))
+        self.sent.append(_raw)
+        return Web3.keccak(_raw)
+
+@pytest.fixture
+def chain(faucet, tmp_path, monkeypatch):
+    monkeypatch.setattr(faucet, 'estimate_gas_price', lambda _chain, _head=None: (50 * GWEI, 2 * GWEI))
+    return SimpleNamespace(name='test', chain_id=137, w3=SimpleNamespace(eth=MockEth()), GAS_PRICE=-1, FEE_LIMIT=100,
+                           GAS_LIMIT=30000, REWARD=0.1, DISPERSE_CONTRACT='', STUCK_TX_BLOCKS=5, tx_watchers={},
+                           journal=faucet.SendJournal(str(tmp_path / 'sends.journal')),
+                           history_storage=faucet.SqliteHistoryStorage(str(tmp_path / 'history.sqlite')))
+
+@pytest.fixture
+def account():
+    return Account.from_key(FAUCET_PRIVKEY)
+
+@pytest.fixture
+def watcher(faucet, chain, account):
+    chain.tx_watchers[account.address] = faucet.PendingTxWatcher(chain, account)
+    return chain.tx_watchers[account.address]
+
+def test_replacement_pricing(faucet):
+    assert faucet.is_replacement_priced((44 * GWEI, 2200), (40 * GWEI, 2000))
+    assert not faucet.is_replacement_priced((44 * GWEI, 2100), (40 * GWEI, 2000))
+    assert not faucet.is_replacement_priced((43 * GWEI, 2200), (40 * GWEI, 2000))
+    assert faucet.is_replacement_priced((44 * GWEI, 0), (40 * GWEI, 0))
+
+def test_stuck_tx_is_replaced(faucet, chain, watcher):
+    watcher.track(0, [RECIPIENT], '0x' + '11' * 32, (40 * GWEI, 2 * GWEI))
+    nonces = {}
+    watcher.check(100, 90, faucet.HandledIndex(100), nonces)
+    assert len(chain.w3.eth.sent) == 0
+    watcher.check(105, 90, faucet.HandledIndex(100), nonces)
+    assert len(chain.w3.eth.sent) == 1
+    tx = watcher.pending[0]
+    assert tx['hash'] == Web3.toHex(Web3.keccak(chain.w3.eth.sent[0]))
+    assert faucet.is_replacement_priced(tx['gas_price'], (40 * GWEI, 2 * GWEI))
+    assert nonces['0'] == tx['gas_price']
+
+def test_replacement_is_not_sent_below_fee_limit(faucet, chain, watcher):
+    # The fee cannot be increased by 10% without exceeding FEE_LIMIT
+    chain.FEE_LIMIT = 42
+    watcher.track(0, [RECIPIENT], '0x' + '11' * 32, (40 * GWEI, 2 * GWEI))
+    watcher.check(100, 90, faucet.HandledIndex(100), {})
+    watcher.check(105, 90, faucet.HandledIndex(100), {})
+    assert len(chain.w3.eth.sent) == 0
+    assert watcher.pending[0]['hash'] == '0x' + '11' * 32
+    assert chain.journal.read() == []
+
+def test_mined_txs_are_forgotten(faucet, chain, watcher):
+    watcher.track(0, [RECIPIENT], '0x' + '11' * 32, (40 * GWEI, 2 * GWEI))
+    watcher.track(1, [RECIPIENT], '0x' + '22' * 32, (40 * GWEI, 2 * GWEI))
+    chain.w3.eth.mined_nonce = 1
+    watcher.check(100, 90, faucet.HandledIndex(100), {})
+    assert list(watcher.pending) == [1]
+
+def test_free_nonces_fill_gaps(faucet, watcher):
+    watcher.track(5, [RECIPIENT], '0x' + '11' * 32, (40 * GWEI, 2 * GWEI))
+    watcher.track(7, [RECIPIENT], '0x' + '22' * 32, (40 * GWEI, 2 * GWEI))
+    assert faucet.free_nonces([watcher], 5, 3) == [6, 8, 9]
+    # The node does not know the transaction with nonce 3 anymore
+    assert faucet.free_nonces([watcher], 3, 2) == [3, 4]
+
+def test_free_nonces_of_shared_account(faucet, chain, account, watcher):
+    other = faucet.PendingTxWatcher(chain, account)
+    watcher.track(0, [RECIPIENT], '0x' + '11' * 32, (40 * GWEI, 2 * GWEI))
+    other.track(1, [RECIPIENT], '0x' + '22' * 32, (40 * GWEI, 2 * GWEI))
+    assert faucet.free_nonces([watcher, other], 0, 2) == [2, 3]
+
+def make_recipients(_count):
+    return [Web3.toChecksumAddress(f'0x{0x2001 + i:040x}') for i in range(_count)]
+
+def test_unsent_reward_is_tracked_and_sent_again(faucet, chain, account, watcher, monkeypatch):
+    # Broadcasts are made one by one, so the first one fails
+    monkeypatch.setattr(faucet, 'BROADCAST_WORKERS', 1)
+    chain.w3.eth.errors.append(INTERNAL_ERROR)
+    recipients = make_recipients(3)
+    nonces = {}
+    sent = faucet.send_rewards(chain, account, [[recipient] for recipient in recipients], [0, 1, 2],
+                               (40 * GWEI, 2 * GWEI), nonces, 100)
+    assert [(nonce, batch) for nonce, batch, _, _ in sent] == [(0, recipients[:1]), (1, recipients[1:2]), 
+                                                              (2, recipients[2:])]
+    assert all([tx_hash is not None for _, _, _, tx_hash in sent])
+    assert len(chain.w3.eth.sent) == 2
+    assert sorted(nonces) == ['0', '1', '2']
+    assert len(chain.journal.read()) == 3
+    # The gap in nonces is not skipped by the next rewards
+    assert watcher.pending[0]['raw'] is not None
+    assert faucet.free_nonces([watcher], 0, 1) == [3]
+
+    watcher.check(101, 90, faucet.HandledIndex(100), nonces)
+    assert len(chain.w3.eth.sent) == 3
+    assert Web3.toHex(Web3.keccak(chain.w3.eth.sent[-1])) == sent[0][3]
+    assert watcher.pending[0]['raw'] is None
+
+def test_journal_skips_truncated_last_entry(faucet, chain):
+    chain.journal.append([{'nonce': 0}, {'nonce': 1}])
+    # The faucet crashed while the entry was written
+    with open(chain.journal.path, 'a') as f:
+        f.write('{"nonce": 2, "recip')
+    assert chain.journal.read() == [{'nonce': 0}, {'nonce': 1}]
+    chain.journal.clear()
+    assert chain.journal.read() == []
+    chain.journal.append([{'nonce': 3}])
+    assert chain.journal.read() == [{'nonce': 3}]
+
+def journal_rewards(_faucet, _chain, _account, _recipients, _block):
+    entries = []
+    for nonce, recipient in enumerate(_recipients):
+        tx = _faucet.build_reward_tx(_chain, [recipient], nonce, (40 * GWEI, 2 * GWEI))
+        entries.append(_faucet.journal_entry(_account, nonce, [recipient], _account.sign_transaction(tx),
+                                             (40 * GWEI, 2 * GWEI), _block))
+    _chain.journal.append(entries)
+    return entries
+
+def test_replay_send_journal(faucet, chain, account, watcher):
+    recipients = make_recipients(3)
+    entries = journal_rewards(faucet, chain, account, recipients, 100)
+    # The first transaction was sent before the restart, the second one is not accepted now
+    chain.w3.eth.errors.extend([{'code': -32000, 'message': 'already known'}, INTERNAL_ERROR])
+    handled_index = faucet.HandledIndex(100)
+    nonces = {}
+    faucet.replay_send_journal(chain, 150, handled_index, nonces)
+
+    assert len(chain.w3.eth.sent) == 1
+    assert chain.journal.read() == []
+    # All journaled transactions are recorded as attempts made in the block they were journaled in
+    assert chain.history_storage.get_last_block() == 150
+    assert chain.history_storage.get_history(0) == {'100': {recipient: entry['hash'] 
+                                                            for recipient, entry in zip(recipients, entries)}}
+    assert all([handled_index.handled_since(recipient, 100) for recipient in recipients])
+    assert nonces == {account.address: {str(nonce): [40 * GWEI, 2 * GWEI] for nonce in range(3)}}
+    assert chain.history_storage.get_nonces() == nonces
+    assert sorted(watcher.pending) == [0, 1, 2]
+    assert [watcher.pending[nonce]['raw'] is not None for nonce in range(3)] == [False, True, False]
+
+def test_replay_of_recorded_journal(faucet, chain, account, watcher):
+    # The faucet stopped after the attempts were committed but before the journal was cleared
+    recipients = make_recipients(2)
+    entries = journal_rewards(faucet, chain, account, recipients, 100)
+    chain.history_storage.add_attempts(100, {recipients[0]: entries[0]['hash']})
+    chain.history_storage.commit(120)
+    chain.w3.eth.errors.append({'code': -32000, 'message': 'nonce too low'})
+    faucet.replay_send_journal(chain, 120, faucet.HandledIndex(100), {})
+    assert chain.history_storage.get_history(0) == {'100': {recipient: entry['hash'] 
+                                                            for recipient, entry in zip(recipients, entries)}}
+    assert chain.journal.read() == []
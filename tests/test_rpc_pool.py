@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+
+HEADER_NOT_FOUND = {'code': -32000, 'message': 'header not found'}
+
+def make_provider(_responses):
+    calls = []
+
+    def make_request(_method, _params):
+        calls.append(_method)
+        return _responses.pop(0) if len(_responses) > 1 else _responses[0]
+
+    return SimpleNamespace(make_request=make_request, calls=calls)
+
+@pytest.fixture
+def make_pool(faucet, monkeypatch):
+    monkeypatch.setattr(faucet, 'RPC_HEDGE_DELAY', 0)
+    monkeypatch.setattr(faucet, 'RPC_BREAKER_FAILURES', 2)
+
+    def make(*_responses):
+        pool = faucet.PooledProvider('test', [f'http://127.0.0.1:{port}' for port in range(1, len(_responses) + 1)])
+        for i, (endpoint, responses) in enumerate(zip(pool.endpoints, _responses)):
+            endpoint.provider = make_provider(list(responses))
+            # The first endpoint is the fastest one
+            endpoint.latency = 0.1 * (i + 1)
+        return pool
+
+    return make
+
+def test_node_errors(faucet):
+    assert faucet.is_node_error(HEADER_NOT_FOUND)
+    assert faucet.is_node_error({'code': -32603, 'message': 'something went wrong'})
+    assert not faucet.is_node_error({'code': -32602, 'message': 'invalid argument 0'})
+    assert not faucet.is_node_error({'code': 3, 'message': 'execution reverted'})
+    assert not faucet.is_node_error({'code': -32005, 'message': 'query returned more than 10000 results'})
+    assert not faucet.is_node_error(None)
+
+def test_read_fails_over_on_node_error(make_pool):
+    pool = make_pool([{'jsonrpc': '2.0', 'id': 1, 'error': HEADER_NOT_FOUND}],
+                     [{'jsonrpc': '2.0', 'id': 1, 'result': '0x10'}])
+    assert pool.make_request('eth_getBalance', ['0x0', 'latest'])['result'] == '0x10'
+    assert pool.endpoints[0].failures == 1
+    assert pool.endpoints[1].failures == 0
+
+def test_node_errors_open_the_breaker(make_pool):
+    pool = make_pool([{'jsonrpc': '2.0', 'id': 1, 'error': HEADER_NOT_FOUND}],
+                     [{'jsonrpc': '2.0', 'id': 1, 'result': '0x10'}])
+    pool.make_request('eth_getBalance', ['0x0', 'latest'])
+    pool.make_request('eth_getBalance', ['0x0', 'latest'])
+    # The failed endpoint is not used while the breaker is open
+    assert pool.ranked_endpoints() == [pool.endpoints[1]]
+    pool.make_request('eth_getBalance', ['0x0', 'latest'])
+    assert len(pool.endpoints[0].provider.calls) == 2
+
+def test_node_error_is_returned_if_all_endpoints_fail(make_pool):
+    pool = make_pool([{'jsonrpc': '2.0', 'id': 1, 'error': HEADER_NOT_FOUND}],
+                     [{'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32603, 'message': 'internal error'}}])
+    assert 'error' in pool.make_request('eth_getBalance', ['0x0', 'latest'])
+    assert [endpoint.failures for endpoint in pool.endpoints] == [1, 1]
+
+def test_request_errors_are_not_failures(make_pool):
+    pool = make_pool([{'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32602, 'message': 'invalid argument 0'}}],
+                     [{'jsonrpc': '2.0', 'id': 1, 'result': '0x10'}])
+    assert 'error' in pool.make_request('eth_getBalance', ['0x0', 'latest'])
+    assert pool.endpoints[0].failures == 0
+    assert len(pool.endpoints[1].provider.calls) == 0
+
+def make_batch_chain(_status, _body):
+    response = SimpleNamespace(status_code=_status, json=lambda: _body, raise_for_status=lambda: None)
+    return SimpleNamespace(rpc_pool=SimpleNamespace(post_batch=lambda _payload: response))
+
+def test_batch_too_large_with_http_200(faucet):
+    chain = make_batch_chain(200, {'jsonrpc': '2.0', 'id': None, 
+                                   'error': {'code': -32600, 'message': 'batch size too large'}})
+    with pytest.raises(faucet.BatchRejected) as rejection:
+        faucet.post_rpc_batch(chain, [('eth_blockNumber', [])] * 2)
+    assert rejection.value.status == 413
+
+def test_batch_not_supported(faucet):
+    chain = make_batch_chain(200, {'jsonrpc': '2.0', 'id': None, 
+                                   'error': {'code': -32600, 'message': 'batch requests are not supported'}})
+    with pytest.raises(faucet.BatchNotSupported):
+        faucet.post_rpc_batch(chain, [('eth_blockNumber', [])] * 2)